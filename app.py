@@ -1,21 +1,34 @@
 import streamlit as st
 import pandas as pd
-import s3fs
 import os
 import logging
-import boto3
+import tempfile
+import time
+import re
+import secrets
 from botocore.exceptions import ClientError
-import openai
-import sqlite3
-import numpy as np
 from PIL import Image
-import requests
 from io import BytesIO
-import io
-import urllib.request
-from PIL import Image, ImageDraw
-from deta import Deta
-from interactive_table import aggrid_multi_select
+from lazy import lazy_import, ensure_loaded
+from interactive_table import aggrid_multi_select, upcoming_rows, current_page
+from gallery import stream_thumbnails, presigned_thumbnail_urls, ThumbnailPrefetcher, DEFAULT_MAX_WORKERS, DEFAULT_PREFETCH_WORKERS, DEFAULT_PREFETCH_BYTES
+from presigned import PresignedUrlCache, image_grid_html, DEFAULT_EXPIRES_IN
+from thumbnails import pick_thumbnail_width, THUMBNAIL_WIDTHS
+from image_cache import ImageCache, DEFAULT_BUDGET_BYTES
+from gallery_index import GalleryIndex, GALLERY_COLUMNS
+from metadata_store import create_store, DEFAULT_SQLITE_PATH
+from generation import DEFAULT_RESPONSE_FORMAT
+from clients import create_s3_client, create_http_session
+import transfers
+from metrics import timed, REGISTRY
+from content_store import content_hash_of_key
+from similarity import DEFAULT_MAX_DISTANCE
+from image_prep import open_image, encode_png, TARGET_SIZE
+from masks import mask_png, section_spec, grid_spec, rect_spec, brush_spec, parse_pairs
+from response_cache import ResponseCache, request_key, DEFAULT_CACHE_PATH, DEFAULT_TTL, DEFAULT_MAX_ENTRIES
+from jobs import JobQueue, JobWorker, DEFAULT_QUEUE_PATH, DEFAULT_JOB_WORKERS, DEFAULT_POLL_INTERVAL
+# Only imported when a session first calls the API
+openai = lazy_import('openai')
 ###########################################################################################################
 # Set page configuration
 st.set_page_config(page_title='Image Generator & Gallery', 
@@ -59,18 +72,180 @@ def check_password():
         return True
 ###########################################################################################################
 if True: # check_password(): - temporarily removed password 
-    # Create connection object.
-    # `anon=False` means not anonymous, i.e. it uses access keys to pull data.
-    fs = s3fs.S3FileSystem(anon=False)
+    # Create connection objects once per process, every session and worker thread shares them.
+    @st.experimental_singleton
+    def get_fs():
+        """
+        S3 filesystem, `anon=False` means not anonymous, i.e. it uses access keys to pull data.
+        s3fs is only imported the first time a file is read.
+        """
+        import s3fs
+        return s3fs.S3FileSystem(anon=False)
+
+    @st.experimental_singleton
+    def get_s3_client():
+        """
+        S3 client with a connection pool sized for the concurrent gallery and upload transfers
+        """
+        return create_s3_client()
+
+    @st.experimental_singleton
+    def get_http_session():
+        """
+        Keep-alive HTTP session for downloading generated images
+        """
+        return create_http_session()
+
+    @st.experimental_singleton
+    def get_transfer_config():
+        """
+        Multipart and byte-range settings for S3 transfers, taken from the secrets
+        """
+        return transfers.create_transfer_config(
+            multipart_threshold=int(st.secrets.get("S3_MULTIPART_THRESHOLD", transfers.MULTIPART_THRESHOLD)),
+            multipart_chunksize=int(st.secrets.get("S3_MULTIPART_CHUNKSIZE", transfers.MULTIPART_CHUNKSIZE)),
+            max_concurrency=int(st.secrets.get("S3_MAX_CONCURRENCY", transfers.MAX_CONCURRENCY)))
+
+    s3_client = get_s3_client()
+    http_session = get_http_session()
+    transfer_config = get_transfer_config()
     ###########################################################################################################
     # Database
-    if "deta" not in st.session_state:
-        st.session_state.deta = Deta(st.secrets["DETA_KEY"])
-    if "db" not in st.session_state:
-        st.session_state.db = st.session_state.deta.Base("aws-app")
+    # METADATA_BACKEND selects where the image records live: "deta" (default) or "sqlite"
+    @st.experimental_singleton
+    def get_metadata_store():
+        """
+        Create the metadata store selected in the secrets, shared by every session on this server
+        """
+        return create_store(st.secrets.get("METADATA_BACKEND", "deta"),
+                            deta_key=st.secrets.get("DETA_KEY"),
+                            sqlite_path=st.secrets.get("SQLITE_PATH", DEFAULT_SQLITE_PATH))
+
+    metadata_store = get_metadata_store()
+
+    # Local copy of the gallery records, synced incrementally and shared by every session on this server
+    @st.experimental_singleton
+    def get_gallery_index():
+        """
+        Create the process-wide gallery index on top of the metadata store
+        """
+        return GalleryIndex(get_metadata_store())
+
+    gallery_index = get_gallery_index()
+
+    # Results of earlier OpenAI requests, images are cached as the S3 keys they were stored under
+    @st.experimental_singleton
+    def get_response_cache():
+        """
+        Open the persistent response cache, with its TTL and size taken from the secrets
+        """
+        return ResponseCache(path=st.secrets.get("RESPONSE_CACHE_PATH", DEFAULT_CACHE_PATH),
+                             ttl=float(st.secrets.get("RESPONSE_CACHE_TTL", DEFAULT_TTL)),
+                             max_entries=int(st.secrets.get("RESPONSE_CACHE_ENTRIES", DEFAULT_MAX_ENTRIES)))
+
+    response_cache = get_response_cache()
+    force_fresh = st.sidebar.checkbox('Force fresh API calls', help='Ignore cached results of identical requests')
+    ###########################################################################################################
+    # OpenAI API key, set once per process. The client reads it from the environment when it is first imported
+    @st.experimental_singleton
+    def configure_openai():
+        """
+        Hand the API key to the OpenAI client without importing it
+        """
+        os.environ["OPENAI_API_KEY"] = st.secrets["NEW_OPENAI_API_KEY"]
+
+    configure_openai()
     ###########################################################################################################
-    # OpenAI API key
-    openai.api_key = st.secrets["NEW_OPENAI_API_KEY"]
+    # Jobs
+    # Generation and save jobs, queued in a SQLite file shared with the workers so results outlive reruns and reconnects
+    @st.experimental_singleton
+    def get_job_queue():
+        """
+        Open the job queue database named in the secrets
+        """
+        return JobQueue(st.secrets.get("JOB_QUEUE_PATH", DEFAULT_QUEUE_PATH))
+
+    job_queue = get_job_queue()
+
+    # Runs the jobs on threads of this process. With START_JOB_WORKER = false they are only
+    # run by separate `python jobs.py` processes, which can be scaled on their own
+    @st.experimental_singleton
+    def start_job_worker():
+        """
+        Start the in-process worker, with its concurrency taken from the secrets
+        """
+        worker = JobWorker(get_job_queue(), get_s3_client(), 'luisappsbucket', get_metadata_store(), get_response_cache(),
+                           http_session=get_http_session(),
+                           transfer_config=get_transfer_config(),
+                           response_format=st.secrets.get("OPENAI_RESPONSE_FORMAT", DEFAULT_RESPONSE_FORMAT),
+                           max_workers=int(st.secrets.get("JOB_WORKERS", DEFAULT_JOB_WORKERS)))
+        return worker.start()
+
+    if st.secrets.get("START_JOB_WORKER", True):
+        start_job_worker()
+    ###########################################################################################################
+    # Gallery settings
+    # Number of images downloaded from S3 at the same time when displaying the gallery
+    gallery_max_workers = int(st.secrets.get("GALLERY_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    # Approximate width in pixels of one of the 4 gallery columns on the wide layout, used to pick a thumbnail size
+    gallery_column_width = int(st.secrets.get("GALLERY_COLUMN_WIDTH", 400))
+    # Number of prompt search results shown in the table at once
+    search_page_size = int(st.secrets.get("SEARCH_PAGE_SIZE", 50))
+    # Number of rows sent to the gallery table at once, filtering and sorting are done on the server
+    table_page_size = int(st.secrets.get("TABLE_PAGE_SIZE", 100))
+    # Perceptual hashes at most this many bits apart are shown as near-duplicates
+    similar_max_distance = int(st.secrets.get("SIMILAR_MAX_DISTANCE", DEFAULT_MAX_DISTANCE))
+    # Number of recent jobs listed in the Jobs panel
+    job_list_size = int(st.secrets.get("JOB_LIST_SIZE", 20))
+    # Seconds between two checks of the jobs this session is waiting for
+    job_poll_interval = float(st.secrets.get("JOB_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+
+    # Decoded gallery thumbnails, shared by every session on this server
+    @st.experimental_singleton
+    def get_image_cache():
+        """
+        Create the process-wide thumbnail cache, with its memory budget taken from the secrets
+        """
+        return ImageCache(budget_bytes=int(st.secrets.get("IMAGE_CACHE_BYTES", DEFAULT_BUDGET_BYTES)))
+
+    image_cache = get_image_cache()
+
+    # Presigned URLs for the gallery's direct-from-S3 mode, reused until shortly before they expire
+    @st.experimental_singleton
+    def get_url_cache():
+        """
+        Create the process-wide presigned URL cache, with the URL lifetime taken from the secrets
+        """
+        return PresignedUrlCache(get_s3_client(), 'luisappsbucket',
+                                 expires_in=int(st.secrets.get("PRESIGNED_URL_EXPIRES", DEFAULT_EXPIRES_IN)))
+
+    url_cache = get_url_cache()
+
+    # Background downloads of the thumbnails a session is likely to open next
+    @st.experimental_singleton
+    def get_prefetcher():
+        """
+        Create the process-wide prefetcher, with its concurrency and memory caps taken from the secrets
+        """
+        return ThumbnailPrefetcher('luisappsbucket', get_image_cache(), get_s3_client(),
+                                   max_workers=int(st.secrets.get("PREFETCH_WORKERS", DEFAULT_PREFETCH_WORKERS)),
+                                   max_bytes=int(st.secrets.get("PREFETCH_BYTES", DEFAULT_PREFETCH_BYTES)))
+
+    prefetcher = get_prefetcher()
+    # Number of rows after the selection whose thumbnails are prefetched
+    prefetch_rows = int(st.secrets.get("PREFETCH_ROWS", 24))
+    # Identifies this session to the shared prefetcher and owns its jobs. Kept in the URL, so a reload
+    # or a reconnect finds the jobs it started. Whoever has the URL sees those jobs and their results,
+    # the id is a random secret and a value that does not look like one is never taken from the URL
+    if 'session_id' not in st.session_state:
+        session_id = st.experimental_get_query_params().get('session', [''])[0]
+        if not re.fullmatch(r'[A-Za-z0-9_-]{43}', session_id):
+            session_id = secrets.token_urlsafe(32)
+        st.session_state.session_id = session_id
+        st.experimental_set_query_params(session=session_id)
+    if 'pending_jobs' not in st.session_state:
+        # Wait again for the jobs left unfinished by an earlier connection
+        st.session_state.pending_jobs = job_queue.unfinished(st.session_state.session_id)
     ###########################################################################################################
     # Retrieve file contents.
     # Uses st.experimental_memo to only rerun when the query changes or after 10 min.
@@ -88,329 +263,248 @@ if True: # check_password(): - temporarily removed password
         -------
         Contents of the file
         """
-        with fs.open(filename) as f:
+        with get_fs().open(filename) as f:
             return f.read().decode("utf-8")
 
 
-    def upload_file(file_name, bucket, object_name=None):
+    def enqueue_job(kind, params, inputs=()):
         """
-        Upload a file to an Amazon Web Services S3 bucket
+        Hand a job to the workers, this session picks up its results on a later rerun
 
         Parameters
         ----------
-        file_name : str
-            File to upload
-        bucket : str
-            Bucket to upload to
-        object_name : str, optional
-            S3 object name. If not specified then file_name is used
+        kind : str
+            'generate', 'variation', 'edit' or 'save'
+        params : dict
+            Parameters of the job, see jobs.JobWorker
+        inputs : list of bytes, optional
+            Encoded images the job works on
 
         Returns
         -------
-        bool
+        str
+            Id of the job
         """
+        job_id = job_queue.enqueue(st.session_state.session_id, kind, params, inputs)
+        st.session_state.pending_jobs.append(job_id)
+        return job_id
 
-        # If S3 object_name was not specified, use file_name
-        if object_name is None:
-            object_name = os.path.basename(file_name)
-
-        # Upload the file
-        s3_client = boto3.client('s3')
-        try:
-            response = s3_client.upload_file(file_name, bucket, object_name)
-        except ClientError as e:
-            logging.error(e)
-            return False
-        return True
 
-
-    def create_and_save_image(given_prompt, save_to_db=False):
+    def save_image_to_database(key, prompt):
         """
-        Create an image from a given prompt and save it to an AWS S3 bucket and a database
+        Save the last generated image to the database
 
         Parameters
         ----------
-        given_prompt : str
-            The prompt to use to generate the image
-        
+        key : str
+            S3 object name of the image to be saved to the database
+        prompt : str
+            The prompt used to generate the image
+
         Returns
         -------
-        PIL.Image
-            The generated image
+        None
+        """        
+        save_images_to_database([key], [prompt])
+
+
+    def save_images_to_database(keys, prompts):
         """
-        try:
-            response = openai.Image.create(
-            prompt=given_prompt,
-            n=1,
-            size=f"1024x1024"
-            )
-            image_url = response['data'][0]['url']
-            unique_id = response['created']
-
-            # Get current date from pandas
-            now = pd.Timestamp('now')
-            date_string = now.strftime('%Y-%m-%d')
-
-            # Open the image from the URL
-            with urllib.request.urlopen(image_url) as url:
-                s = url.read()
-
-            # If save to database selected, save to S3 and database
-            if save_to_db:
-                # Save the image to a file with a given string, current date and time
-                file_name = f"{unique_id}_{date_string}.jpg"
-                
-                # Save the image to the local directory
-                with open(file_name, 'wb') as f:
-                    f.write(s)
-                
-                upload_file(file_name, "luisappsbucket", object_name=None)
-                
-                # Add entry to database
-                st.session_state.db.put({'id': unique_id, 
-                                        'date': date_string, 
-                                        'prompt': given_prompt, 
-                                        'image': file_name})
-
-            image = Image.open(BytesIO(s))
-
-            return image
-        except openai.error.OpenAIError as e:
-            st.warning(e.http_status)
-            st.warning(e.error)
-
-
-    def create_variant_and_save(image, num_variations=1): 
-        """
-        Create a variant of the image and save to S3 bucket and database
-        
+        Queue a save of several generated images, the worker reads them from the bucket, uploads them
+        in parallel and writes their records in bulk
+
+        Images are stored under a hash of their PNG bytes, which their result keys already carry.
+        Images already in the gallery are not queued, and bytes already in the bucket are not uploaded again.
+
         Parameters
         ----------
-        image_for_variation : PIL image
-            The image to be used to create the variant
-        
+        keys : list of str
+            S3 object names of the images to be saved to the database
+        prompts : list of str
+            The prompt of each image
+
         Returns
         -------
-        image : PIL image
-            The variant image
+        int
+            Number of images queued
         """
-        try:
-            # Read the image file from disk and resize it
-            # image = Image.open("image.png")
-            width, height = 1024,1024
-            image = image.resize((width, height))
-
-            # Convert the image to a BytesIO object
-            byte_stream = BytesIO()
-            image.save(byte_stream, format='PNG')
-            byte_array = byte_stream.getvalue()
-
-            # Create the variant
-            response = openai.Image.create_variation(
-            image=byte_array,
-            n=num_variations,
-            size="1024x1024"
-            )
-
-            # Get the image URL and unique ID
-            image_url = response['data'][0]['url']
-            unique_id = response['created']
-
-            # Get current date from pandas
-            now = pd.Timestamp('now')
-            date_string = now.strftime('%Y-%m-%d')
-
-            # Open the image from the URL
-            with urllib.request.urlopen(image_url) as url:
-                s = url.read()
-
-            # Save the image to a file with a given string, current date and time
-            # file_name = f"{unique_id}_{date_string}.png"
-            
-            # Save the image to the local directory
-            # with open(file_name, 'wb') as f:
-            #     f.write(s)
-            
-            # Uncomment to upload to S3 bucket
-            # upload_file(file_name, "luisappsbucket", object_name=None)
-            
-            # Add entry to database (uncomment to add to database)
-            # st.session_state.db.put({'id': unique_id, 
-            #                         'date': date_string, 
-            #                         'prompt': f'Variant {unique_id}', 
-            #                         'image': file_name})
-
-            image = Image.open(BytesIO(s))
-
-            return image, unique_id
-        
-        except openai.error.OpenAIError as e:
-            st.warning(e.http_status)
-            st.warning(e.error)
+        # Skip images already in the gallery, and repeats of the same image
+        pending = {}
+        for key, prompt in zip(keys, prompts):
+            digest = content_hash_of_key(key)
+            if digest not in gallery_index:
+                pending.setdefault(digest, (key, prompt))
+        if pending:
+            pending_keys, pending_prompts = zip(*pending.values())
+            enqueue_job('save', {'prompts': list(pending_prompts), 'keys': list(pending_keys)})
+        return len(pending)
+
+
+    def job_caption(job):
+        """
+        Caption of a job and of the images it produced, e.g. 'Variant #1679000000'
+        """
+        params, result = job['params'], job['result'] or {}
+        if job['kind'] == 'generate':
+            return params['prompt']
+        if job['kind'] == 'variation':
+            return f"Variant #{result.get('id', '')}"
+        if job['kind'] == 'edit':
+            return f"{params['prompt']} {result.get('id', '')}"
+        return f"Save of {len(params['prompts'])} images"
 
 
-    def edit_image_and_save(image, mask, prompt, num_variations=1): 
+    def apply_job(job):
         """
-        Create a variant of the image and save to S3 bucket and database
-        
+        Bring the results of a finished job into this session
+
+        New gallery records are added to the local index. The keys of the generated images become the
+        candidates, the images of a batch are added to the candidates as each job finishes. Nothing is
+        downloaded here, the browser loads the images from S3 and the full image is only read when it is
+        used for a variation or an edit.
+
         Parameters
         ----------
-        image_for_variation : PIL image
-            The image to be used to create the variant
-        
+        job : dict
+            A job in the 'done' state, as returned by the queue
+
         Returns
         -------
-        image : PIL image
-            The variant image
+        None
         """
-        try:
-            # Resize both the image and the mask
-            width, height = 1024, 1024
-            image = image.resize((width, height))
-            mask = mask.resize((width, height))
-
-            # Convert the image to a BytesIO object
-            byte_stream = BytesIO()
-            image.save(byte_stream, format='PNG')
-            byte_array = byte_stream.getvalue()
-
-            # Convert the mask to a BytesIO object
-            byte_stream_mask = BytesIO()
-            mask.save(byte_stream_mask, format='PNG')
-            byte_array_mask = byte_stream_mask.getvalue()
-
-            # Edit picture
-            response = openai.Image.create_edit(
-            image=byte_array,
-            mask=byte_array_mask,
-            prompt=prompt,
-            n=num_variations,
-            size="1024x1024"
-            )
-
-            # Get the image URL and unique ID
-            image_url = response['data'][0]['url']
-            unique_id = response['created']
-
-            # Get current date from pandas
-            now = pd.Timestamp('now')
-            date_string = now.strftime('%Y-%m-%d')
-
-            # Open the image from the URL
-            with urllib.request.urlopen(image_url) as url:
-                s = url.read()
-
-            # Save the image to a file with a given string, current date and time
-            # file_name = f"{unique_id}_{date_string}.png"
-            
-            # Save the image to the local directory
-            # with open(file_name, 'wb') as f:
-            #     f.write(s)
-            
-            # Uncomment to upload to S3 bucket
-            # upload_file(file_name, "luisappsbucket", object_name=None)
-            
-            # Add entry to database (uncomment to add to database)
-            # st.session_state.db.put({'id': unique_id, 
-            #                         'date': date_string, 
-            #                         'prompt': f'Variant {unique_id}', 
-            #                         'image': file_name})
-
-            image = Image.open(BytesIO(s))
-
-            return image, unique_id
-        
-        except openai.error.OpenAIError as e:
-            st.warning(e.http_status)
-            st.warning(e.error)
+        for record in job['result'].get('records', []):
+            gallery_index.add(record)
+        if job['kind'] == 'save':
+            return
+        set_candidates(job['result']['keys'], job_caption(job), append=job['params'].get('index') is not None)
+
 
-    def save_image_to_database(img, prompt):
+    def set_candidates(keys, caption, append=False):
         """
-        Save the last generated image to the database
+        Keep the images returned by one request on session state so each one can be saved
 
         Parameters
         ----------
-        img : PIL image
-            The image to be saved to the database
-        temp_file_name : str
-            The name of the temporary file
-        prompt : str
-            The prompt used to generate the image
+        keys : list of str
+            S3 object names of the generated images
+        caption : str
+            Caption of the request, numbered per image when there are several
+        append : bool, optional
+            Add the images after the current candidates instead of replacing them, for the jobs of a batch
 
         Returns
         -------
         None
-        """        
-        # Date string
-        date_string = pd.Timestamp('now').strftime('%Y-%m-%d')
+        """
+        if len(keys) == 1:
+            captions = [caption]
+        else:
+            captions = [f"{caption} ({i+1}/{len(keys)})" for i in range(len(keys))]
+        previous = st.session_state.get('candidates', []) if append else []
+        st.session_state.candidates = previous + list(zip(keys, captions))
+        # The first image becomes the current one, used by the next variation, edit or manual save
+        st.session_state.image_key = keys[0]
+        st.session_state.prompt = captions[0]
 
-        # Generate a unique id thhat starts with 'Manual' and ends with a random 4-digit number
-        unique_id = 'Manual'+str(np.random.randint(1000, 9999))
-        unique_name = unique_id+'.png'
 
-        # Save to temporary file
-        img.save(unique_name)
-        
-        # Uncomment to upload to S3 bucket
-        upload_file(unique_name, "luisappsbucket", object_name=None)
+    def load_current_image():
+        """
+        Download the current image at full size, when a variation or an edit of it is requested
 
-        # Add entry to database (uncomment to add to database)
-        st.session_state.db.put({'id': unique_id, 
-                                'date': date_string, 
-                                'prompt': prompt, 
-                                'image': unique_name})
+        Returns
+        -------
+        PIL image or None
+            None, after showing a warning, if there is no current image or it is no longer stored
+        """
+        if 'image_key' not in st.session_state:
+            st.warning('No image has been generated yet, please generate an image first')
+            return None
+        try:
+            data = transfers.download_bytes(s3_client, 'luisappsbucket', st.session_state.image_key, config=transfer_config)
+        except ClientError as e:
+            logging.error(e)
+            st.warning('The current image is no longer stored, please generate it again')
+            return None
+        return open_image(data)
 
 
-    def mask_section(img, section):
+    def build_mask_spec(mask_mode, section, grid_size, grid_cells, rect_x, rect_y, brush_points, brush_radius):
         """
-        Mask a section of the image
+        Turn the Image Editor options into a mask spec
 
         Parameters
         ----------
-        img : PIL image
-            The image to be masked
+        mask_mode : str
+            'Section', 'Grid cells', 'Rectangle' or 'Brush'
         section : str
-            The section to be masked
+            One of the nine named sections
+        grid_size : (int, int)
+            Rows and columns of the grid
+        grid_cells : str
+            Cells to edit as 'row,column' pairs counted from 0, e.g. '0,0 1,2'
+        rect_x, rect_y : (int, int)
+            Horizontal and vertical extent of the rectangle, in percent
+        brush_points : str
+            Stroke points as 'x,y' pairs in percent, e.g. '10,10 50,40'
+        brush_radius : int
+            Brush radius, in percent of the width
 
         Returns
         -------
-        masked_img : PIL image
-            The masked image
+        tuple
+            The mask spec
         """
-        # Divide the image into 9 sections
-        width, height = img.size
-        w_third = width // 3
-        h_third = height // 3
-        
-        # Define the coordinates for each section
-        if section == "top-left":
-            box = (0, 0, w_third, h_third)
-        elif section == "top-center":
-            box = (w_third, 0, 2 * w_third, h_third)
-        elif section == "top-right":
-            box = (2 * w_third, 0, width, h_third)
-        elif section == "middle-left":
-            box = (0, h_third, w_third, 2 * h_third)
-        elif section == "middle-center":
-            box = (w_third, h_third, 2 * w_third, 2 * h_third)
-        elif section == "middle-right":
-            box = (2 * w_third, h_third, width, 2 * h_third)
-        elif section == "bottom-left":
-            box = (0, 2 * h_third, w_third, height)
-        elif section == "bottom-center":
-            box = (w_third, 2 * h_third, 2 * w_third, height)
-        elif section == "bottom-right":
-            box = (2 * w_third, 2 * h_third, width, height)
+        if mask_mode == 'Grid cells':
+            return grid_spec(grid_size[0], grid_size[1], parse_pairs(grid_cells, int))
+        if mask_mode == 'Rectangle':
+            return rect_spec(rect_x[0] / 100, rect_y[0] / 100, rect_x[1] / 100, rect_y[1] / 100)
+        if mask_mode == 'Brush':
+            points = [(x / 100, y / 100) for x, y in parse_pairs(brush_points)]
+            return brush_spec(points, brush_radius / 100)
+        return section_spec(section)
+
+
+    def display_gallery_images(selected_df, presigned_mode):
+        """
+        Show the thumbnails of some gallery records in four columns
+
+        Parameters
+        ----------
+        selected_df : pd.DataFrame
+            The records to show, with 'image' and 'prompt' columns
+        presigned_mode : bool
+            Let the browser load the thumbnails from S3 instead of sending them through this server
+
+        Returns
+        -------
+        None
+        """
+        if presigned_mode:
+            # Only sign URLs here, the image bytes never pass through this server
+            urls = presigned_thumbnail_urls(selected_df['image'].tolist(), 'luisappsbucket',
+                                            width=pick_thumbnail_width(gallery_column_width),
+                                            url_cache=url_cache,
+                                            max_workers=gallery_max_workers,
+                                            s3_client=s3_client)
+            st.markdown(image_grid_html(urls, selected_df['prompt'].tolist(), columns=4), unsafe_allow_html=True)
         else:
-            raise ValueError("Invalid section")
-        
-        # Create a mask with the selected section blacked out
-        mask = Image.new("1", img.size, color=255)
-        draw = ImageDraw.Draw(mask)
-        draw.rectangle(box, fill=0)
-        masked_img = Image.composite(img, Image.new("RGBA", img.size), mask)
-        
-        return masked_img
+            cols = st.columns(4)
+            captions = selected_df['prompt'].tolist()
+            # Lay out a placeholder for every image up front, so each one can be filled in as soon as it arrives
+            slots = [cols[count%4].empty() for count in range(len(captions))]
+            for slot in slots:
+                slot.caption('Loading...')
+
+            # Load the selected images, from the cache when possible, showing a small preview first.
+            # Images are not kept once displayed, memory does not grow with the size of the selection
+            thumbnails = stream_thumbnails(selected_df['image'].tolist(), 'luisappsbucket', image_cache,
+                                           width=pick_thumbnail_width(gallery_column_width),
+                                           preview_width=THUMBNAIL_WIDTHS[0],
+                                           max_workers=gallery_max_workers,
+                                           s3_client=s3_client)
+            for count, image, final in thumbnails:
+                # Display the image, a preview is replaced in place by the final one
+                slots[count].image(image, caption=captions[count], use_column_width=True)
 
     ###########################################################################################################
     st.title('Image Generator & Gallery')
@@ -427,14 +521,24 @@ if True: # check_password(): - temporarily removed password
         submit = st.form_submit_button('Submit prompt')
         if submit:
             try:
-                response = openai.ChatCompletion.create(
-                             model="gpt-3.5-turbo",
-                             messages=[
-                                 {"role": "system", "content": "You are a helpful assistant."},
-                                 {"role": "user", "content": f"{prompt}"}
-                                 ]
-                            )
-                response_text = response['choices'][0]['message']['content']
+                # Identical prompts are answered from the cache
+                request = request_key(model="gpt-3.5-turbo", prompt=prompt)
+                cached = None if force_fresh else response_cache.get(request)
+                if cached is not None:
+                    response_text = cached['text']
+                else:
+                    # The job worker may be importing the client at the same time
+                    ensure_loaded(openai)
+                    with timed('openai.chat'):
+                        response = openai.ChatCompletion.create(
+                                     model="gpt-3.5-turbo",
+                                     messages=[
+                                         {"role": "system", "content": "You are a helpful assistant."},
+                                         {"role": "user", "content": f"{prompt}"}
+                                         ]
+                                    )
+                    response_text = response['choices'][0]['message']['content']
+                    response_cache.put(request, {'text': response_text})
                 st.write(response_text)
             except openai.error.OpenAIError as e:
                 st.warning(e.http_status)
@@ -448,14 +552,25 @@ if True: # check_password(): - temporarily removed password
         prompt = st.text_area('Enter a prompt for the image generator')
         # Create a button to generate the image
         if st.form_submit_button('Generate Image'):
-            # Generate the image
-            image = create_and_save_image(prompt, save_to_database)
-            # Display the image
-            st.image(image, caption=prompt, use_column_width=False, width=500)
-            # Save prompt to session state in case the user wants to save image to database
-            st.session_state.prompt = prompt
-            # Save image to session state in case the user wants to generate a variation or edit
-            st.session_state.image = image
+            # Queue the image, once it is ready it becomes the current image for a variation, edit or save
+            enqueue_job('generate', {'prompt': prompt, 'save': save_to_database, 'fresh': force_fresh})
+            st.info('Image queued, it will show below when it is ready')
+
+    #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Form to create many images at once
+    with st.form(key='batch_generate'):
+        st.subheader("Batch Generator")
+        save_batch = st.checkbox('Save images to database', value=True)
+        batch_prompts = st.text_area('Enter one prompt per line')
+        repeats = st.number_input('Images per prompt', min_value=1, max_value=10, value=1, step=1)
+        if st.form_submit_button('Generate Batch'):
+            prompts = [p.strip() for p in batch_prompts.splitlines() if p.strip()]
+            prompts = [p for p in prompts for _ in range(int(repeats))]
+            # One job per image, the workers run them in parallel and each image is added to the candidates as it arrives
+            st.session_state.candidates = []
+            for index, p in enumerate(prompts):
+                enqueue_job('generate', {'prompt': p, 'save': save_batch, 'fresh': force_fresh, 'index': index})
+            st.info(f'{len(prompts)} images queued, follow them in the Jobs panel')
 
     #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Form to create a variant of an image
@@ -464,37 +579,24 @@ if True: # check_password(): - temporarily removed password
         # Options for form 
         use_previous = st.checkbox('Generate a variation of the previous image, leave unchecked if uploading an image')
         uploaded = st.file_uploader('Upload an image to generate a variation')
+        num_variations = st.number_input('Number of variations', min_value=1, max_value=10, value=1, step=1)
 
         # Submit button to generate the image
         sbn = st.form_submit_button('Generate Variations')
 
         if sbn:
             if use_previous == True:
-                if 'image' not in st.session_state:
-                    st.warning('No image has been generated yet, please generate an image first')
+                img = load_current_image()
+                if img is None:
                     st.stop()
-                else:
-                    # Generate the image
-                    image, unique_id = create_variant_and_save(image=st.session_state.image)
-                    # Display the image
-                    st.image(image, caption=f"Variant #{unique_id}", use_column_width=False, width=500)
-                    # Save the prompt to the session state in case the user wants to save the image to the database
-                    st.session_state.prompt = f"Variant #{unique_id}"
-                    # Save the image to the session state in case the user wants to generate a variation or edit
-                    st.session_state.image = image
             else:
                 # To read file as bytes and convert to pillow image
                 bytes_data = uploaded.getvalue()
-                stream = io.BytesIO(bytes_data)
-                img = Image.open(stream)
-                # Generate the image
-                image, unique_id = create_variant_and_save(image=img)
-                # Display the image
-                st.image(image, caption=f"Variant #{unique_id}", use_column_width=False, width=500)
-                # Save the prompt to the session state in case the user wants to save the image to the database
-                st.session_state.prompt = f"Variant #{unique_id}"
-                # Save the image to the session state in case the user wants to generate a variation or edit
-                st.session_state.image = image
+                img = open_image(bytes_data)
+            # Resize to 1024x1024 and encode as PNG, passing the original bytes through when
+            # the image is already a PNG of that size, and reusing earlier encodings of the same image
+            enqueue_job('variation', {'n': int(num_variations), 'fresh': force_fresh}, [encode_png(img, TARGET_SIZE)])
+            st.info('Variations queued, they will show below when they are ready')
 
     #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Image Editor 
@@ -502,46 +604,77 @@ if True: # check_password(): - temporarily removed password
         st.subheader("Image Editor")
         # Options for form
         use_previous = st.checkbox('Edit the the last generated image, leave unchecked if uploading an image')
+        mask_mode = st.radio('Mask', ['Section', 'Grid cells', 'Rectangle', 'Brush'], horizontal=True)
         section = st.selectbox('Select a section to mask', ['top-left', 'top-center', 'top-right', 'middle-left', 'middle-center', 'middle-right', 'bottom-left', 'bottom-center', 'bottom-right'])
+        with st.expander('Grid, rectangle and brush options'):
+            grid_rows = st.number_input('Grid rows', min_value=1, max_value=16, value=3, step=1)
+            grid_cols = st.number_input('Grid columns', min_value=1, max_value=16, value=3, step=1)
+            grid_cells = st.text_input('Grid cells to edit, as row,column pairs counted from 0', value='1,1')
+            rect_x = st.slider('Rectangle horizontal extent (%)', 0, 100, (25, 75))
+            rect_y = st.slider('Rectangle vertical extent (%)', 0, 100, (25, 75))
+            brush_points = st.text_input('Brush stroke, as x,y pairs in %', value='20,20 50,50 80,20')
+            brush_radius = st.slider('Brush radius (%)', 1, 25, 5)
         prompt = st.text_area('Enter a prompt for the image editor')
         uploaded = st.file_uploader('Upload an image to be edited')
+        num_edits = st.number_input('Number of edited images', min_value=1, max_value=10, value=1, step=1)
 
         # Submit button to generate the image
         sbn = st.form_submit_button('Generate Edited Image')
         if sbn:
+            # Mask part of the image where the user wants to edit
+            try:
+                mask = build_mask_spec(mask_mode, section, (int(grid_rows), int(grid_cols)), grid_cells,
+                                       rect_x, rect_y, brush_points, brush_radius)
+            except ValueError as e:
+                st.warning(f'Invalid mask: {e}')
+                st.stop()
             if use_previous == True:
-                if 'image' not in st.session_state:
-                    st.warning('No image has been generated yet, please generate an image first')
+                img = load_current_image()
+                if img is None:
                     st.stop()
-                else:
-                    # Mask part of the image where the user wants to edit
-                    mask = mask_section(st.session_state.image, section)
-                    # Generate the edited image
-                    image, unique_id = edit_image_and_save(image=st.session_state.image,
-                                                            mask=mask,
-                                                            prompt=prompt)
-                    # Display the image
-                    st.image(image, caption=f"{prompt} {unique_id}", use_column_width=False, width=500)
-                    # Add prompt to session state in case user wants to save image to database
-                    st.session_state.prompt = f"{prompt} {unique_id}"
-                    st.session_state.image = image
             else:
                 # To read file as bytes and convert to pillow image
                 bytes_data = uploaded.getvalue()
-                stream = io.BytesIO(bytes_data)
-                img = Image.open(stream)
-                # Mask part of the image where the user wants to edit
-                mask = mask_section(img, section)
-                # Generate the edited image
-                image, unique_id = edit_image_and_save(image=img, 
-                                                        mask=mask, 
-                                                        prompt=prompt)
-                # Display the image
-                st.image(image, caption=f"{prompt} {unique_id}", use_column_width=False, width=500)
-                # Add prompt to session state in case user wants to save image to database
-                st.session_state.prompt = f"{prompt} {unique_id}"
-                # Add image to session state in case user wants to generate a variation or edit
-                st.session_state.image = image
+                img = open_image(bytes_data)
+            # The image is resized and encoded as PNG, the mask is built directly at the target size
+            # and its PNG is memoized per spec
+            enqueue_job('edit', {'prompt': prompt, 'n': int(num_edits), 'fresh': force_fresh},
+                        [encode_png(img, TARGET_SIZE), mask_png(mask, TARGET_SIZE)])
+            st.info('Edit queued, the images will show below when they are ready')
+
+    #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Results of the jobs this session is waiting for, taken in as they finish
+    waiting = list(st.session_state.pending_jobs)
+    pending_jobs = []
+    for job in job_queue.get(waiting):
+        if job['status'] == 'done':
+            apply_job(job)
+        elif job['status'] == 'failed':
+            st.warning(f"{job_caption(job)}: {job['message']}")
+        else:
+            pending_jobs.append(job['id'])
+    # Keep the jobs queued again while taking in the results
+    st.session_state.pending_jobs = pending_jobs + st.session_state.pending_jobs[len(waiting):]
+
+    #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Images returned by the last generation, variation or edit, each one can be saved or picked for the next step
+    if st.session_state.get('candidates'):
+        st.subheader("Generated images")
+        if st.button('Save all'):
+            keys, captions = zip(*st.session_state.candidates)
+            saved = save_images_to_database(list(keys), list(captions))
+            st.success(f'{saved} of {len(keys)} images queued to be saved to database')
+        cols = st.columns(4)
+        for index, (key, caption) in enumerate(st.session_state.candidates):
+            with cols[index%4]:
+                # The browser loads the image straight from S3, the script only signs its URL
+                st.markdown(image_grid_html([url_cache.url(key)], [caption], columns=1), unsafe_allow_html=True)
+                if st.button('Save', key=f'save_candidate_{index}'):
+                    save_image_to_database(key=key, prompt=caption)
+                    st.success(f'Image {caption} queued to be saved to database')
+                if st.button('Use as current image', key=f'use_candidate_{index}'):
+                    st.session_state.image_key = key
+                    st.session_state.prompt = caption
 
     #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Manual Save
@@ -549,57 +682,132 @@ if True: # check_password(): - temporarily removed password
         st.subheader("Manual Save")
         st.write("Use this form to manually save the last generated image (variant, edit, or original) to the database. Uses the last prompt on session state.")
         if st.form_submit_button('Save Image'):
-            if 'image' not in st.session_state:
+            if 'image_key' not in st.session_state:
                 st.warning('No image has been generated yet, please generate an image first')
                 st.stop()
             else:
                 # Save the last generated image to the database with the last prompt on session state
-                # For temporary file, just use the name 'temp.png'
-                save_image_to_database(img=st.session_state.image, 
+                save_image_to_database(key=st.session_state.image_key, 
                                         prompt=st.session_state.prompt)
-                st.success(f'Image {st.session_state.prompt} saved to database')
+                st.success(f'Image {st.session_state.prompt} queued to be saved to database')
+
+    #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Jobs of this session, including the ones started before a reload, whose results can be taken in again
+    recent_jobs = job_queue.recent(st.session_state.session_id, limit=job_list_size)
+    if recent_jobs:
+        with st.expander('Jobs', expanded=bool(st.session_state.pending_jobs)):
+            st.caption("The link of this page opens these jobs and their results, don't share it")
+            for job in recent_jobs:
+                cols = st.columns([5, 1])
+                message = f" ({job['message']})" if job['message'] else ''
+                cols[0].caption(f"{job['status'].capitalize()}: {job_caption(job)}{message}")
+                if job['status'] == 'done' and job['kind'] != 'save':
+                    if cols[1].button('Use results', key=f"use_job_{job['id']}"):
+                        apply_job(job)
+                        st.experimental_rerun()
 
     #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Display the gallery
     st.write('## Gallery')
     st.write('The gallery below displays all the images generated by the app. Click on an image to view it in full size.')
 
-    # Get all the images from the database
-    df = st.session_state.db.fetch().items
-    df = pd.DataFrame(df)
+    # Get all the images from the local index, only records newer than the last sync are pulled from the database
+    if st.button('Refresh gallery'):
+        gallery_index.sync(force=True)
+    else:
+        gallery_index.sync()
+    # Search the prompts on the server, only the current page of matches is sent to the table
+    search_query = st.text_input('Search prompts', help='Every word is matched as a prefix, best matches first')
+    if search_query:
+        search_page = st.number_input('Results page', min_value=1, value=1, step=1)
+        keys, total = gallery_index.search(search_query,
+                                           limit=search_page_size,
+                                           offset=(search_page - 1) * search_page_size)
+        st.caption(f'{total} matching images')
+        df = gallery_index.dataframe(keys)
+    else:
+        df = gallery_index.dataframe()
+    # Show only the first image of each group of near-duplicates, e.g. one of several similar variants
+    if st.checkbox('Collapse near-duplicates'):
+        df = df[df['key'].isin(gallery_index.collapse(df['key'].tolist(), max_distance=similar_max_distance))]
     
-    with st.form("Display selected images"):
-        # Display a list of checkboxes for each image
-        selection = aggrid_multi_select(df.loc[:,['prompt','date','id','image','key']])
+    # Display a list of checkboxes for each image, one page at a time
+    selection = aggrid_multi_select(df.loc[:,GALLERY_COLUMNS], page_size=table_page_size, key="gallery_table")
 
-        # Create a button to display the selected images
-        if st.form_submit_button('Display'):
-            # Display the selected images
-            filtered_selection = selection.iloc[:,1:]
+    # Either the browser loads the images straight from S3, or the server downloads them and sends them on
+    presigned_mode = st.radio('Load images', ['Directly from S3', 'Through the app server'], horizontal=True,
+                              index=0 if st.secrets.get("GALLERY_PRESIGNED", True) else 1) == 'Directly from S3'
 
-            # Get the selected images
-            selected_df = df[df['prompt'].isin(filtered_selection['prompt'])]
+    # While the user looks at the table, load the selected thumbnails and the rows after them in the background,
+    # a new selection or page replaces what was queued. The browser loads the images itself in presigned mode
+    if presigned_mode:
+        prefetcher.cancel(st.session_state.session_id)
+    else:
+        prefetcher.prefetch(st.session_state.session_id,
+                            selection['image'].tolist() + upcoming_rows("gallery_table", prefetch_rows)['image'].tolist(),
+                            width=pick_thumbnail_width(gallery_column_width))
+
+    # Create a button to display the selected images. What is displayed is kept on session state,
+    # so the images stay on the page when a finished job reruns the script
+    if st.button('Display'):
+        # Get the selected images, the selection is kept across pages by key
+        st.session_state.displayed_keys = df.loc[df['key'].isin(selection['key']), 'key'].tolist()
+    if st.session_state.get('displayed_keys'):
+        display_gallery_images(gallery_index.dataframe(st.session_state.displayed_keys), presigned_mode)
+
+    # The forms below only offer the selected images and the current table page, not the whole gallery
+    page_rows = pd.concat([selection, current_page("gallery_table")], ignore_index=True).drop_duplicates('image')
+    page_images = page_rows['image'].tolist()
+
+    # Images that look like a given one, e.g. the variants made from it
+    with st.form("Find similar"):
+        similar_name = st.selectbox('Find images similar to', page_images)
+        if st.form_submit_button('Find similar') and similar_name is not None:
+            similar_key = page_rows.loc[page_rows['image'] == similar_name, 'key'].iloc[0]
+            st.session_state.similar_keys = gallery_index.similar(similar_key, max_distance=similar_max_distance)
+        # Kept on session state like the displayed images, None until the first search
+        if st.session_state.get('similar_keys'):
+            display_gallery_images(gallery_index.dataframe(st.session_state.similar_keys), presigned_mode)
+        elif st.session_state.get('similar_keys') is not None:
+            st.info('No similar images found')
+
+    # Open a single image at full size, the gallery above only shows thumbnails
+    with st.form("Open image"):
+        image_name = st.selectbox('Select an image to open at full size', page_images)
+        if st.form_submit_button('Open') and image_name is not None:
+            if presigned_mode:
+                st.markdown(image_grid_html([url_cache.url(image_name)], [image_name], columns=1), unsafe_allow_html=True)
+            else:
+                data = transfers.download_bytes(s3_client, 'luisappsbucket', image_name, config=transfer_config)
+                st.image(Image.open(BytesIO(data)), caption=image_name, use_column_width=True)
 
-            # Create a list to store the images
-            image_list = []
+    #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-            cols = st.columns(4)
-            # Display the selected images
-            count = 0
-            for index, row in selected_df.iterrows():
-                
-                # Download the image from S3
-                s3 = boto3.client('s3')
-                with open('temp', 'wb') as f:
-                    s3.download_fileobj('luisappsbucket', row['image'], f)
-
-                # Open the image
-                image = Image.open('temp')
-                image_list.append(image)
-
-                # Display the image
-                with cols[count%4]:
-                    st.image(image, caption=row['prompt'], use_column_width=True)
-                count += 1
+    # Admin panel, time and bytes per stage for every external call and image codec, for this server process
+    if st.secrets.get("SHOW_METRICS", True):
+        with st.sidebar.expander('Performance'):
+            st.dataframe(pd.DataFrame(REGISTRY.summary()))
+            st.caption(f"Thumbnail cache: {image_cache.stats()}")
+            st.download_button('Prometheus metrics', REGISTRY.prometheus_text(), file_name='metrics.prom', mime='text/plain')
+            st.download_button('JSON lines', REGISTRY.json_lines(), file_name='metrics.jsonl', mime='application/json')
+            if st.button('Reset metrics'):
+                REGISTRY.reset()
+    # For a Prometheus node exporter textfile collector, rewritten after every run. Written next to
+    # the target and renamed over it, so the collector never reads a half-written file
+    if st.secrets.get("METRICS_TEXTFILE"):
+        textfile = st.secrets["METRICS_TEXTFILE"]
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(textfile)), suffix='.tmp', delete=False) as f:
+            f.write(REGISTRY.prometheus_text())
+        os.replace(f.name, textfile)
 
     #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Wait for this session's jobs once the page is drawn, rerunning as soon as one finishes.
+    # Any interaction stops the wait, the page never waits on OpenAI or S3 itself
+    job_status = st.empty()
+    while st.session_state.pending_jobs:
+        jobs = job_queue.get(st.session_state.pending_jobs)
+        if len(jobs) < len(st.session_state.pending_jobs) or any(job['status'] in ('done', 'failed') for job in jobs):
+            st.experimental_rerun()
+        running = sum(job['status'] == 'running' for job in jobs)
+        job_status.info(f"Waiting for {len(jobs)} jobs, {running} running")
+        time.sleep(job_poll_interval)
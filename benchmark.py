@@ -0,0 +1,548 @@
+"""
+Offline benchmarks of the generate -> save -> gallery pipeline.
+
+Runs the functions the app is built from against local stand-ins, so results do not
+depend on the network or on API quotas:
+
+- S3 is a moto server started on a local port, or a local S3 server given with --s3-endpoint
+- The OpenAI image endpoints are served by a local HTTP server that answers with the
+  images in examples/, inline (b64_json) or as URLs. --api-latency and --download-latency
+  stand in for the round-trips to the API and to the image host
+- The metadata store is an in-memory SQLite database
+
+moto is only needed here, it is not part of the app's requirements:
+
+    pip install "moto[server]"
+    python benchmark.py --gallery-sizes 10,1000,100000 --selection-sizes 4,16,64 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+    python benchmark.py --import-report
+
+--import-report prints where the cold start of app.py goes, from `python -X importtime`
+over the modules app.py imports at the top.
+
+app.py is a Streamlit script and cannot be imported, so each benchmark calls the
+module functions that the matching part of app.py delegates to.
+"""
+import argparse
+import ast
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+BUCKET = 'benchmark-bucket'
+# A benchmark is reported as a regression when its median is this much slower than in the baseline
+REGRESSION_THRESHOLD = 1.2
+# and at least this many seconds slower, sub-millisecond timings are mostly noise
+REGRESSION_MIN_SECONDS = 0.005
+# Words the synthetic prompts are made of
+WORDS = ('cat', 'dog', 'castle', 'forest', 'ocean', 'city', 'robot', 'dragon', 'sunset', 'mountain',
+         'painting', 'portrait', 'neon', 'watercolor', 'salvador', 'dali', 'artstation', 'detailed')
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """
+    Answers the image generation, variation and edit endpoints with the example images
+
+    A few random bytes are appended to every image served, decoders ignore them, so
+    each generation is a new image to the content-addressed storage like a real one.
+    The server runs in the benchmark process, so the base64 payloads are prepared
+    once and its own work per request is kept small.
+    """
+    images = []
+    encoded = []
+    latency = 0.0
+    download_latency = 0.0
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('latin-1')
+        # JSON for generations, multipart form fields for variations and edits
+        n = int((re.search(r'"n":\s*(\d+)', body) or re.search(r'name="n"\r\n\r\n(\d+)', body) or [None, 1])[1])
+        inline = 'b64_json' in body
+        items = []
+        for _ in range(n):
+            index = random.randrange(len(self.images))
+            if inline:
+                # The images are padded to a multiple of 3 bytes, so the encoded suffix can simply be appended
+                items.append(b'{"b64_json": "' + self.encoded[index] + base64.b64encode(os.urandom(15)) + b'"}')
+            else:
+                items.append(json.dumps({'url': f"http://{self.headers['Host']}/files/{index}"}).encode())
+        time.sleep(self.latency)
+        self._send(b'{"created": %d, "data": [%s]}' % (int(time.time()), b', '.join(items)), 'application/json')
+
+    def do_GET(self):
+        # The URL of a generated image, a separate connection to another host for the real API
+        time.sleep(self.download_latency)
+        self._send(self.images[int(self.path.rsplit('/', 1)[1])] + os.urandom(15), 'image/png')
+
+    def _send(self, payload, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_openai(latency, download_latency):
+    """
+    Serve FakeOpenAI on a free local port and point the openai client at it
+
+    Parameters
+    ----------
+    latency : float
+        Seconds each API request waits before answering
+    download_latency : float
+        Seconds each image download waits before answering
+
+    Returns
+    -------
+    ThreadingHTTPServer
+    """
+    import openai
+    images = [open(os.path.join(EXAMPLES_DIR, name), 'rb').read() for name in sorted(os.listdir(EXAMPLES_DIR))]
+    FakeOpenAI.images = [image + b'\0' * (-len(image) % 3) for image in images]
+    FakeOpenAI.encoded = [base64.b64encode(image) for image in FakeOpenAI.images]
+    FakeOpenAI.latency = latency
+    FakeOpenAI.download_latency = download_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai.api_key = 'benchmark'
+    openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server
+
+
+def start_moto_server():
+    """
+    Run moto as a real HTTP server, its in-process mock would also intercept the calls to the fake OpenAI server
+
+    Returns
+    -------
+    (ThreadedMotoServer, str)
+        The server and its endpoint URL
+    """
+    from moto.server import ThreadedMotoServer
+    # Not one log line per request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def measure(fn, repeat):
+    """
+    Run `fn` `repeat` times
+
+    Returns
+    -------
+    dict
+        Timings in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {'runs': repeat,
+            'median_s': float(np.median(timings)),
+            'p95_s': float(np.percentile(timings, 95)),
+            'min_s': min(timings),
+            'mean_s': float(np.mean(timings))}
+
+
+def synthetic_records(count, keys, seed=0):
+    """
+    Gallery records with random prompts and dates, pointing at `keys` in turn
+    """
+    rng = random.Random(seed)
+    return [{'key': f"record-{i}",
+             'id': f"bench{i}",
+             'date': f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+             'prompt': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+             'image': keys[i % len(keys)]}
+            for i in range(count)]
+
+
+def bench_generate_and_save(results, s3_client, http_session, repeat):
+    # The generate job of the worker, saving to the gallery, for both response formats
+    from generation import generate_image
+    from jobs import JobWorker
+    from metadata_store import SQLiteStore
+    from response_cache import ResponseCache
+
+    store = SQLiteStore(':memory:')
+    for response_format in ('b64_json', 'url'):
+        worker = JobWorker(None, s3_client, BUCKET, store, ResponseCache(':memory:'), http_session=http_session,
+                           response_format=response_format)
+
+        def generate():
+            generate_image('a castle in the clouds', http_session=http_session, response_format=response_format)
+
+        def generate_and_save():
+            worker.generate({'id': None, 'params': {'prompt': 'a castle in the clouds', 'save': True, 'fresh': True}})
+
+        results.append(dict(benchmark='generate', params={'response_format': response_format}, **measure(generate, repeat)))
+        results.append(dict(benchmark='generate_and_save', params={'response_format': response_format},
+                            **measure(generate_and_save, repeat)))
+
+
+def bench_jobs(results, s3_client, http_session, job_counts, repeat):
+    # Jobs from enqueue to done as the app sees them, through the queue and a worker thread
+    import tempfile
+    from jobs import JobQueue, JobWorker
+    from metadata_store import SQLiteStore
+    from response_cache import ResponseCache
+
+    with tempfile.TemporaryDirectory() as directory:
+        queue = JobQueue(os.path.join(directory, 'jobs.db'))
+        worker = JobWorker(queue, s3_client, BUCKET, SQLiteStore(':memory:'), ResponseCache(':memory:'),
+                           http_session=http_session, poll_interval=0.01)
+        stop = worker.start()
+        try:
+            for count in job_counts:
+                def run_jobs():
+                    ids = [queue.enqueue('benchmark', 'generate', {'prompt': f'a castle {i}', 'save': False})
+                           for i in range(count)]
+                    while any(job['status'] not in ('done', 'failed') for job in queue.get(ids)):
+                        time.sleep(0.01)
+
+                results.append(dict(benchmark='jobs', params={'jobs': count, 'workers': worker.max_workers},
+                                    **measure(run_jobs, repeat)))
+        finally:
+            stop.set()
+
+
+def bench_variation(results, http_session, repeat):
+    # create_variant_and_save without the cache: PNG encoding, the API call and the images of the response
+    import openai
+    from generation import response_images
+    from image_prep import encode_png, open_image, TARGET_SIZE
+
+    source = open_image(FakeOpenAI.images[0])
+    for response_format in ('b64_json', 'url'):
+        def variation():
+            response = openai.Image.create_variation(image=encode_png(source, TARGET_SIZE), n=2, size="1024x1024",
+                                                     response_format=response_format)
+            [open_image(data) for data in response_images(response, http_session=http_session)]
+
+        results.append(dict(benchmark='variation', params={'response_format': response_format, 'n': 2},
+                            **measure(variation, repeat)))
+
+
+def bench_transfers(results, s3_client, sizes_mb, repeat):
+    # upload_bytes and download_bytes for objects below and above the multipart threshold, with the app's
+    # transfer settings and with a single stream per object
+    import transfers
+
+    configs = {'multipart': transfers.create_transfer_config(),
+               'single': transfers.create_transfer_config(multipart_threshold=1024 * transfers.MB)}
+    for size_mb in sizes_mb:
+        data = os.urandom(int(size_mb * transfers.MB))
+        for name, config in configs.items():
+            key = f"transfers/{size_mb}-{name}.bin"
+            params = {'size_mb': size_mb, 'config': name,
+                      'above_threshold': len(data) > transfers.MULTIPART_THRESHOLD}
+            for operation, fn in (('upload', lambda: transfers.upload_bytes(s3_client, data, BUCKET, key, config=config)),
+                                  ('download', lambda: transfers.download_bytes(s3_client, BUCKET, key, config=config))):
+                timing = measure(fn, repeat)
+                timing['mb_per_s'] = round(size_mb / timing['median_s'], 1) if timing['median_s'] else None
+                results.append(dict(benchmark=f'transfer_{operation}', params=params, **timing))
+
+
+def bench_save_image_to_database(results, s3_client, repeat):
+    # A save job: encode, check and upload, thumbnails and one bulk write. Saving again only checks
+    from image_prep import encode_png
+    from jobs import JobWorker
+    from metadata_store import SQLiteStore
+    from PIL import Image
+    from response_cache import ResponseCache
+    from io import BytesIO
+
+    worker = JobWorker(None, s3_client, BUCKET, SQLiteStore(':memory:'), ResponseCache(':memory:'))
+    images = [Image.open(BytesIO(data)) for data in FakeOpenAI.images]
+
+    def save():
+        worker.save({'id': None, 'params': {'prompts': ['manual'] * len(images)},
+                     'inputs': [encode_png(image) for image in images]})
+
+    results.append(dict(benchmark='save_image_to_database', params={'images': len(images), 'state': 'new'}, **measure(save, 1)))
+    results.append(dict(benchmark='save_image_to_database', params={'images': len(images), 'state': 'already saved'},
+                        **measure(save, repeat)))
+
+
+def bench_masks(results, repeat):
+    # The Image Editor mask, built from scratch and then from the memoized PNG
+    from masks import mask_alpha, mask_png, section_spec, grid_spec, MASK_SIZE
+
+    for name, spec in (('section', section_spec('middle-center')), ('grid', grid_spec(3, 3, [(0, 0), (1, 1), (2, 2)]))):
+        def cold():
+            mask_alpha.cache_clear()
+            mask_png.cache_clear()
+            mask_png(spec, MASK_SIZE)
+
+        results.append(dict(benchmark='mask', params={'spec': name, 'cache': 'cold'}, **measure(cold, repeat)))
+        results.append(dict(benchmark='mask', params={'spec': name, 'cache': 'warm'},
+                            **measure(lambda: mask_png(spec, MASK_SIZE), repeat)))
+
+
+def bench_gallery(results, s3_client, gallery_sizes, selection_sizes, repeat):
+    # Gallery section: index sync, prompt search, table paging and the thumbnail loop
+    from gallery import stream_thumbnails
+    from gallery_index import GalleryIndex
+    from image_cache import ImageCache
+    from interactive_table import page_dataframe
+    from metadata_store import SQLiteStore
+    from thumbnails import ensure_thumbnail, pick_thumbnail_width, THUMBNAIL_WIDTHS
+
+    # One distinct object per selected image, with its thumbnails already made like for any image saved by the app
+    keys = []
+    for i in range(max(selection_sizes)):
+        key = f"bench/{i}.png"
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=FakeOpenAI.images[i % len(FakeOpenAI.images)])
+        for width in THUMBNAIL_WIDTHS:
+            ensure_thumbnail(s3_client, BUCKET, key, width)
+        keys.append(key)
+    width = pick_thumbnail_width(400)
+
+    for gallery_size in gallery_sizes:
+        store = SQLiteStore(':memory:')
+        store.put_many(synthetic_records(gallery_size, keys))
+        params = {'gallery_size': gallery_size}
+
+        index = GalleryIndex(store)
+        results.append(dict(benchmark='gallery_sync', params=dict(params, sync='full'),
+                            **measure(lambda: index.sync(force=True), repeat)))
+
+        def incremental():
+            # Past the sync interval, so every call asks the store for new records
+            index.last_sync = -float('inf')
+            index.sync()
+
+        results.append(dict(benchmark='gallery_sync', params=dict(params, sync='incremental'), **measure(incremental, repeat)))
+        results.append(dict(benchmark='prompt_search', params=params,
+                            **measure(lambda: index.search('salvador dal', limit=50), repeat)))
+
+        df = index.dataframe()
+        results.append(dict(benchmark='table_page', params=dict(params, view='sorted'),
+                            **measure(lambda: page_dataframe(df, 1, 100, sort_by='date', ascending=False), repeat)))
+        results.append(dict(benchmark='table_page', params=dict(params, view='filtered'),
+                            **measure(lambda: page_dataframe(df, 1, 100, filter_text='dragon'), repeat)))
+
+    for selection_size in selection_sizes:
+        selected = keys[:selection_size]
+        for state in ('cold', 'warm'):
+            cache = ImageCache()
+            if state == 'warm':
+                for _ in stream_thumbnails(selected, BUCKET, cache, width, s3_client=s3_client):
+                    pass
+            first = []
+
+            def display():
+                start = time.perf_counter()
+                thumbnails = stream_thumbnails(selected, BUCKET, cache if state == 'warm' else ImageCache(), width,
+                                               preview_width=THUMBNAIL_WIDTHS[0], s3_client=s3_client)
+                for count, (index, image, final) in enumerate(thumbnails):
+                    if count == 0:
+                        first.append(time.perf_counter() - start)
+
+            timing = measure(display, repeat)
+            timing['first_image_median_s'] = float(np.median(first))
+            results.append(dict(benchmark='gallery_display', params={'selection_size': selection_size, 'cache': state},
+                                **timing))
+
+
+def app_imports(path=APP_PATH):
+    """
+    Modules imported at the top of app.py, in order. Imports inside functions are left out, they are paid on first use
+
+    Returns
+    -------
+    list of str
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        modules.extend(name for name in names if name not in modules)
+    return modules
+
+
+def import_times(modules, repeat=3):
+    """
+    Time importing `modules` in a fresh interpreter with `python -X importtime`
+
+    Parameters
+    ----------
+    modules : list of str
+        Imported in this order, as app.py does
+    repeat : int, optional
+        Interpreters started, the run with the median wall time is reported
+
+    Returns
+    -------
+    dict
+        'wall_s': seconds to import everything, 'modules': [{'module', 'cumulative_ms'}] of
+        `modules`, slowest first. Modules already pulled in by an earlier import show as cheap
+    """
+    code = f"import time; start = time.perf_counter(); import {', '.join(modules)}; print(time.perf_counter() - start)"
+    runs = []
+    for _ in range(repeat):
+        # Run from the repository so the app's own modules are found
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                 cwd=os.path.dirname(APP_PATH))
+        if process.returncode:
+            raise RuntimeError(process.stderr.strip().splitlines()[-1])
+        rows = []
+        for line in process.stderr.splitlines():
+            # "import time:  self [us] | cumulative | imported package", nested imports are indented further
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\S.*)$', line)
+            if match and match.group(3) in modules:
+                rows.append({'module': match.group(3), 'cumulative_ms': round(int(match.group(2)) / 1000, 1)})
+        runs.append((float(process.stdout.strip()), rows))
+    wall, rows = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    return {'wall_s': round(wall, 3), 'modules': sorted(rows, key=lambda row: -row['cumulative_ms'])}
+
+
+def compare(results, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """
+    Print the change of every benchmark against a previous run
+
+    Returns
+    -------
+    list of str
+        Names of the benchmarks whose median got slower than `threshold` times the baseline,
+        by more than REGRESSION_MIN_SECONDS
+    """
+    with open(baseline_path) as f:
+        baseline = {(row['benchmark'], json.dumps(row['params'], sort_keys=True)): row for row in json.load(f)['results']}
+    regressions = []
+    for row in results:
+        name = (row['benchmark'], json.dumps(row['params'], sort_keys=True))
+        old = baseline.get(name)
+        if old is None or not old['median_s']:
+            continue
+        ratio = row['median_s'] / old['median_s']
+        flag = 'REGRESSION' if ratio > threshold and row['median_s'] - old['median_s'] > REGRESSION_MIN_SECONDS else ''
+        print(f"{name[0]:24} {name[1]:60} {old['median_s'] * 1000:10.2f} ms -> {row['median_s'] * 1000:10.2f} ms  x{ratio:.2f} {flag}")
+        if flag:
+            regressions.append(f"{name[0]} {name[1]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the generate, save and gallery paths')
+    parser.add_argument('--gallery-sizes', default='10,1000,100000', help='Comma separated numbers of gallery records')
+    parser.add_argument('--selection-sizes', default='4,16,64', help='Comma separated numbers of images displayed')
+    parser.add_argument('--transfer-sizes', default='1,32',
+                        help='Comma separated object sizes in MB for the S3 transfer benchmark, the multipart threshold is 8')
+    parser.add_argument('--job-counts', default='1,8', help='Comma separated numbers of jobs queued at once')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each benchmark')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Seconds the fake OpenAI server waits per request')
+    parser.add_argument('--download-latency', type=float, default=0.1,
+                        help='Seconds the fake server waits per image download, a new TLS connection to another host')
+    parser.add_argument('--s3-endpoint', help='Local S3 server to use instead of starting a moto server')
+    parser.add_argument('--output', help='JSON file to write the results to, printed if not specified')
+    parser.add_argument('--compare', help='JSON file of an earlier run, exits with 1 if a benchmark regressed')
+    parser.add_argument('--import-report', action='store_true',
+                        help="Only print the time taken by each of app.py's top-level imports")
+    args = parser.parse_args()
+
+    try:
+        startup = import_times(app_imports())
+    except RuntimeError as e:
+        # e.g. streamlit is not installed where the benchmarks run
+        print(f"Skipping the import report: {e}", file=sys.stderr)
+        startup = None
+    if args.import_report:
+        if startup is None:
+            sys.exit(1)
+        print(f"app.py imports: {startup['wall_s'] * 1000:.0f} ms")
+        for row in startup['modules']:
+            print(f"{row['cumulative_ms']:10.1f} ms  {row['module']}")
+        return
+    gallery_sizes = [int(size) for size in args.gallery_sizes.split(',')]
+    selection_sizes = [int(size) for size in args.selection_sizes.split(',')]
+    job_counts = [int(count) for count in args.job_counts.split(',')]
+    transfer_sizes = [float(size) for size in args.transfer_sizes.split(',')]
+
+    import boto3
+    from clients import create_http_session
+    from metrics import REGISTRY
+
+    moto_server = None
+    endpoint = args.s3_endpoint
+    if endpoint is None:
+        moto_server, endpoint = start_moto_server()
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    s3_client = boto3.client('s3', region_name='us-east-1', endpoint_url=endpoint)
+    s3_client.create_bucket(Bucket=BUCKET)
+    server = start_fake_openai(args.api_latency, args.download_latency)
+    http_session = create_http_session()
+    random.seed(0)
+
+    results = []
+    try:
+        bench_generate_and_save(results, s3_client, http_session, args.repeat)
+        bench_jobs(results, s3_client, http_session, job_counts, args.repeat)
+        bench_variation(results, http_session, args.repeat)
+        bench_save_image_to_database(results, s3_client, args.repeat)
+        bench_transfers(results, s3_client, transfer_sizes, args.repeat)
+        bench_masks(results, args.repeat)
+        bench_gallery(results, s3_client, gallery_sizes, selection_sizes, args.repeat)
+    finally:
+        server.shutdown()
+        if moto_server is not None:
+            moto_server.stop()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {'meta': {'time': time.time(),
+                       'commit': commit,
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'args': vars(args)},
+              'results': results,
+              'startup_imports': startup,
+              'stages': REGISTRY.summary()}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        regressions = compare(results, args.compare)
+        if regressions:
+            print(f"{len(regressions)} regressions")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import boto3
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept open to S3, enough for the gallery, batch and upload pools running at once
+S3_MAX_POOL_CONNECTIONS = 32
+# Connections kept open per host for downloading generated images
+HTTP_POOL_SIZE = 16
+# Seconds to wait for a generated image download (connect, read)
+HTTP_TIMEOUT = (5, 60)
+
+
+def create_s3_client(max_pool_connections=S3_MAX_POOL_CONNECTIONS):
+    """
+    Create an S3 client meant to be shared by every thread of the process
+
+    Parameters
+    ----------
+    max_pool_connections : int, optional
+        Size of the connection pool, should be at least the number of concurrent transfers
+
+    Returns
+    -------
+    boto3 S3 client
+    """
+    config = Config(max_pool_connections=max_pool_connections,
+                    retries={'max_attempts': 5, 'mode': 'adaptive'},
+                    tcp_keepalive=True)
+    # A dedicated session, the default one is not thread-safe to create clients from
+    return boto3.session.Session().client('s3', config=config)
+
+
+def create_http_session(pool_size=HTTP_POOL_SIZE):
+    """
+    Create a keep-alive HTTP session for downloading generated images
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Connections kept open per host
+
+    Returns
+    -------
+    requests.Session
+    """
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,177 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import transfers
+from metrics import timed
+
+# File extension of each content type the app stores
+_EXTENSIONS = {'image/png': 'png',
+               'image/jpeg': 'jpg',
+               'image/gif': 'gif',
+               'image/webp': 'webp'}
+# Images that are only displayed, never saved to the gallery, are stored under this prefix, see `expire_results`
+RESULTS_PREFIX = 'results/'
+# Days a displayed result is kept, longer than the response cache TTL so a cached response never points at a deleted object
+DEFAULT_RESULTS_EXPIRATION_DAYS = 8
+# Id of the lifecycle rule written by `expire_results`
+_RESULTS_RULE_ID = 'expire-results'
+
+
+def content_hash(data):
+    """
+    SHA-256 of the encoded bytes, the identity of a saved image
+
+    Returns
+    -------
+    str
+        64 hex characters
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def content_key(data, prefix=''):
+    """
+    S3 object name of some image bytes, derived from their contents
+
+    The same bytes always map to the same name, so saving them twice stores them once,
+    and two different images can never overwrite each other.
+
+    Parameters
+    ----------
+    data : bytes
+        Encoded image
+    prefix : str, optional
+        Start of the name, e.g. RESULTS_PREFIX
+
+    Returns
+    -------
+    str
+        e.g. '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08.png'
+    """
+    extension = _EXTENSIONS.get(transfers.content_type_for(data, ''), 'bin')
+    return f"{prefix}{content_hash(data)}.{extension}"
+
+
+def content_hash_of_key(key):
+    """
+    Hash of the bytes stored under a content key, whatever its prefix
+
+    Returns
+    -------
+    str
+        e.g. '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08' for 'results/9f86...0a08.png'
+    """
+    return key.rsplit('/', 1)[-1].split('.')[0]
+
+
+def object_exists(s3_client, bucket, key):
+    """
+    Whether `key` is already in the bucket, with a HEAD request instead of a download
+    """
+    # A missing object is an answer, not an error of the stage
+    with timed('s3.head'):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+    return True
+
+
+def put_content(s3_client, data, bucket, config=None, prefix=''):
+    """
+    Upload image bytes under their content key, unless the bucket already has them
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the check and the upload
+    data : bytes
+        Encoded image
+    bucket : str
+        Bucket to upload to
+    config : TransferConfig, optional
+        Multipart settings
+    prefix : str, optional
+        Start of the object name, e.g. RESULTS_PREFIX
+
+    Returns
+    -------
+    (str, bool)
+        The S3 object name and whether the bytes were transferred
+    """
+    key = content_key(data, prefix=prefix)
+    if object_exists(s3_client, bucket, key):
+        return key, False
+    transfers.upload_bytes(s3_client, data, bucket, key, config=config)
+    return key, True
+
+
+def put_many_content(s3_client, items, bucket, config=None, max_workers=transfers.BATCH_UPLOAD_WORKERS, prefix=''):
+    """
+    `put_content` for several images at the same time
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the checks and uploads, its pool should allow `max_workers` connections
+    items : list of bytes
+        Encoded images
+    bucket : str
+        Bucket to upload to
+    config : TransferConfig, optional
+        Multipart settings for each object
+    max_workers : int, optional
+        Upper bound on objects in flight
+    prefix : str, optional
+        Start of the object names, e.g. RESULTS_PREFIX
+
+    Returns
+    -------
+    list
+        (key, uploaded) for each image, or the exception it raised, in the same order as `items`
+    """
+    def put(data):
+        try:
+            return put_content(s3_client, data, bucket, config=config, prefix=prefix)
+        except Exception as e:
+            return e
+
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(put, items))
+
+
+def expire_results(s3_client, bucket, days=DEFAULT_RESULTS_EXPIRATION_DAYS):
+    """
+    Have the bucket delete the objects under RESULTS_PREFIX `days` after they were written
+
+    The other lifecycle rules of the bucket are kept, an earlier rule of this function is replaced.
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client allowed to change the lifecycle configuration of the bucket
+    bucket : str
+        Bucket the results are stored in
+    days : int, optional
+        Age of a result when it is deleted
+
+    Returns
+    -------
+    None
+    """
+    try:
+        rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket)['Rules']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+            raise
+        rules = []
+    rules = [rule for rule in rules if rule.get('ID') != _RESULTS_RULE_ID]
+    rules.append({'ID': _RESULTS_RULE_ID,
+                  'Filter': {'Prefix': RESULTS_PREFIX},
+                  'Status': 'Enabled',
+                  'Expiration': {'Days': days}})
+    s3_client.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={'Rules': rules})
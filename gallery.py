@@ -0,0 +1,312 @@
+import itertools
+import queue
+import threading
+from clients import create_s3_client
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import timed
+from thumbnails import ensure_thumbnail, get_thumbnail, thumbnail_key
+
+# Maximum number of S3 downloads in flight at once for a single gallery view
+DEFAULT_MAX_WORKERS = 8
+# Background downloads in flight at once for prefetching, shared by every session
+DEFAULT_PREFETCH_WORKERS = 4
+# Decoded bytes a single prefetch request may add to the cache, so it never pushes out what is on screen
+DEFAULT_PREFETCH_BYTES = 64 * 1024 * 1024
+# Sessions whose latest prefetch request is remembered, the least recently active ones are forgotten beyond this
+MAX_PREFETCH_OWNERS = 256
+
+
+def download_image_bytes(s3_client, bucket, key):
+    """
+    Download a single object from S3 into memory
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the download, safe to share across threads
+    bucket : str
+        Bucket to download from
+    key : str
+        S3 object name
+
+    Returns
+    -------
+    (bytes, str)
+        Contents of the object and its ETag
+    """
+    with timed('s3.download') as span:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        data = response['Body'].read()
+        span.nbytes = len(data)
+    return data, response.get('ETag')
+
+
+def load_thumbnail(s3_client, bucket, cache, key, width):
+    """
+    Download and decode the thumbnail of `key` and add it to the cache
+
+    Returns
+    -------
+    PIL.Image
+        The thumbnail
+    """
+    data, etag = get_thumbnail(s3_client, bucket, key, width)
+    # BytesIO shares the buffer of the downloaded bytes, so PIL decodes them without a copy
+    with timed('pil.decode', len(data)):
+        thumbnail = Image.open(BytesIO(data))
+        thumbnail.load()
+    cache.put(thumbnail_key(key, width), thumbnail, etag=etag)
+    return thumbnail
+
+
+def fetch_images(keys, bucket, max_workers=DEFAULT_MAX_WORKERS, s3_client=None):
+    """
+    Download several S3 objects concurrently through one shared client
+
+    Results are yielded in the same order as `keys`, each one as soon as it and
+    every key before it have finished downloading, so a caller can render them
+    into a grid while the rest are still in flight.
+
+    Parameters
+    ----------
+    keys : list of str
+        S3 object names, in display order
+    bucket : str
+        Bucket to download from
+    max_workers : int, optional
+        Upper bound on concurrent downloads
+    s3_client : boto3 S3 client, optional
+        Client to use. If not specified a new pooled one is created and shared by all workers
+
+    Yields
+    ------
+    (str, bytes)
+        The key and the contents of the object
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    if s3_client is None:
+        s3_client = create_s3_client()
+
+    max_workers = max(1, min(max_workers, len(keys)))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        results = executor.map(lambda key: download_image_bytes(s3_client, bucket, key)[0], keys)
+        for key, data in zip(keys, results):
+            yield key, data
+    finally:
+        # A caller that stops early, e.g. a rerun of the script, does not wait for the remaining downloads
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_thumbnails(keys, bucket, cache, width, preview_width=None, max_workers=DEFAULT_MAX_WORKERS, s3_client=None):
+    """
+    Load gallery thumbnails and yield each one as soon as it is ready, in any order
+
+    Thumbnails already in the cache are yielded without touching S3. One slow download
+    does not hold back the images after it, and nothing is kept once it has been yielded,
+    so the caller only holds one image at a time whatever the number of keys. With `preview_width`, the smaller thumbnail is loaded
+    first and yielded as a preview, then replaced by the one at `width`.
+
+    Parameters
+    ----------
+    keys : list of str
+        S3 object names of the originals
+    bucket : str
+        Bucket to download from
+    cache : ImageCache
+        Process-wide cache of decoded thumbnails
+    width : int
+        Thumbnail width, one of THUMBNAIL_WIDTHS
+    preview_width : int, optional
+        Smaller thumbnail width to show first. No previews if not specified, or not smaller than `width`
+    max_workers : int, optional
+        Upper bound on concurrent downloads
+    s3_client : boto3 S3 client, optional
+        Client to use. Only created if at least one key is missing from the cache
+
+    Yields
+    ------
+    (int, PIL.Image, bool)
+        Position of the key in `keys`, its thumbnail, and False for a preview or True for the final image
+    """
+    pending = []
+    for index, key in enumerate(keys):
+        image = cache.get(thumbnail_key(key, width))
+        if image is not None:
+            yield index, image, True
+        else:
+            pending.append((index, key))
+    if not pending:
+        return
+    if s3_client is None:
+        s3_client = create_s3_client()
+    with_previews = preview_width is not None and preview_width < width
+
+    # Workers hand results over through the queue, no future keeps a reference to an image
+    results = queue.Queue()
+
+    def load(index, key, load_width, final):
+        try:
+            image = cache.get(thumbnail_key(key, load_width))
+            if image is None:
+                image = load_thumbnail(s3_client, bucket, cache, key, load_width)
+            results.put((index, image, final))
+        except Exception as e:
+            results.put((index, e, final))
+
+    done = set()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending))))
+    try:
+        # Previews are queued first, so every cell gets something on screen before the first full image
+        if with_previews:
+            for index, key in pending:
+                executor.submit(load, index, key, preview_width, False)
+        for index, key in pending:
+            executor.submit(load, index, key, width, True)
+        for _ in range(len(pending) * (2 if with_previews else 1)):
+            index, image, final = results.get()
+            if isinstance(image, Exception):
+                if final:
+                    raise image
+                # A missing preview only means the cell waits for the final image
+                continue
+            if final:
+                done.add(index)
+            elif index in done:
+                continue
+            yield index, image, final
+            del image
+    finally:
+        # A caller that stops early, e.g. a rerun of the script, does not wait for the remaining downloads
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def presigned_thumbnail_urls(keys, bucket, width, url_cache, max_workers=DEFAULT_MAX_WORKERS, s3_client=None):
+    """
+    Presigned URLs of gallery thumbnails, so the browser can load them straight from S3
+
+    Keys whose URL is already cached cost nothing. For the others the thumbnail is
+    checked (and generated if missing) concurrently before its URL is signed.
+
+    Parameters
+    ----------
+    keys : list of str
+        S3 object names of the originals, in display order
+    bucket : str
+        Bucket holding the images
+    width : int
+        Thumbnail width, one of THUMBNAIL_WIDTHS
+    url_cache : PresignedUrlCache
+        Process-wide cache of signed URLs for `bucket`
+    max_workers : int, optional
+        Upper bound on concurrent checks
+    s3_client : boto3 S3 client, optional
+        Client to use. Only created if at least one URL is missing from the cache
+
+    Returns
+    -------
+    list of str
+        One URL per key, in the same order
+    """
+    keys = list(keys)
+    thumbnail_keys = [thumbnail_key(key, width) for key in keys]
+    missing = [key for key, thumb in zip(keys, thumbnail_keys) if url_cache.get(thumb) is None]
+    if missing:
+        if s3_client is None:
+            s3_client = create_s3_client()
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+            list(executor.map(lambda key: ensure_thumbnail(s3_client, bucket, key, width), missing))
+    return [url_cache.url(thumb) for thumb in thumbnail_keys]
+
+
+class ThumbnailPrefetcher:
+    """
+    Warms the thumbnail cache in the background with the images a session is likely to open next.
+
+    One bounded pool serves every session. Every request gets a new generation number,
+    and queued downloads of a session whose current request has another generation are
+    dropped before they start, so changing the selection cancels the previous prefetch.
+    Each request stops once it has added `max_bytes` of decoded images to the cache.
+    Only the `max_owners` most recently active sessions are remembered, Streamlit does
+    not say when a session ends.
+    """
+
+    def __init__(self, bucket, cache, s3_client, max_workers=DEFAULT_PREFETCH_WORKERS, max_bytes=DEFAULT_PREFETCH_BYTES,
+                 max_owners=MAX_PREFETCH_OWNERS):
+        self.bucket = bucket
+        self.cache = cache
+        self.s3_client = s3_client
+        self.max_bytes = max_bytes
+        self.max_owners = max_owners
+        self.prefetched = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self._generations = itertools.count(1)
+        self._requests = {}  # owner -> (generation, keys, width), least recently active first
+        self._budgets = {}  # owner -> bytes left for the current generation
+        self._lock = threading.Lock()
+
+    def prefetch(self, owner, keys, width):
+        """
+        Replace the pending prefetch of `owner` with `keys`, in priority order
+
+        Parameters
+        ----------
+        owner : str
+            Id of the session asking, requests of other sessions are not affected
+        keys : list of str
+            S3 object names of the originals
+        width : int
+            Thumbnail width, one of THUMBNAIL_WIDTHS
+        """
+        keys = list(keys)
+        with self._lock:
+            # Moved to the end, as the most recently active session
+            previous = self._requests.pop(owner, None)
+            if previous is not None and previous[1:] == (keys, width):
+                # Same rows as the last rerun, let the queued downloads carry on
+                self._requests[owner] = previous
+                return
+            generation = next(self._generations)
+            self._requests[owner] = (generation, keys, width)
+            self._budgets[owner] = self.max_bytes
+            while len(self._requests) > self.max_owners:
+                self._forget(next(iter(self._requests)))
+        for key in keys:
+            if thumbnail_key(key, width) in self.cache:
+                continue
+            self._executor.submit(self._load, owner, generation, key, width)
+
+    def cancel(self, owner):
+        """
+        Drop everything `owner` has queued and forget the session, downloads already running still finish
+        """
+        with self._lock:
+            self._forget(owner)
+
+    def _forget(self, owner):
+        self._requests.pop(owner, None)
+        self._budgets.pop(owner, None)
+
+    def _is_current(self, owner, generation):
+        request = self._requests.get(owner)
+        return request is not None and request[0] == generation
+
+    def _load(self, owner, generation, key, width):
+        with self._lock:
+            if not self._is_current(owner, generation) or self._budgets[owner] <= 0:
+                return
+        if thumbnail_key(key, width) in self.cache:
+            return
+        try:
+            thumbnail = load_thumbnail(self.s3_client, self.bucket, self.cache, key, width)
+        except Exception:
+            # Best effort, the gallery reports the error if the image is opened
+            return
+        with self._lock:
+            self.prefetched += 1
+            if self._is_current(owner, generation):
+                self._budgets[owner] -= self.cache.sizeof(thumbnail)
@@ -0,0 +1,142 @@
+import threading
+import time
+import pandas as pd
+from prompt_search import PromptIndex
+from similarity import BKTree, collapse, DEFAULT_MAX_DISTANCE
+
+# Columns shown in the gallery table, in order
+GALLERY_COLUMNS = ['prompt', 'date', 'id', 'image', 'key']
+# Minimum number of seconds between two incremental syncs with the database
+DEFAULT_SYNC_INTERVAL = 30
+
+
+class GalleryIndex:
+    """
+    Local copy of the gallery records, shared across reruns and sessions.
+
+    The first sync reads the whole metadata store. Later syncs only ask for records
+    dated on or after the newest date already seen (the high-water mark), so the
+    cost of a rerun does not grow with the size of the gallery. Records written by
+    this process are added directly with `add`. Prompts are kept in a full-text
+    index that is updated record by record, and perceptual hashes in a BK-tree
+    for finding near-duplicates.
+    """
+
+    def __init__(self, store, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.store = store
+        self.sync_interval = sync_interval
+        self.high_water = None
+        self.last_sync = None
+        self._records = {}  # key -> record
+        self._df = None
+        self._search_index = PromptIndex()
+        self._hashes = {}  # key -> perceptual hash as int
+        self._hash_tree = BKTree()
+        self._lock = threading.Lock()
+
+    def sync(self, force=False):
+        """
+        Bring the index up to date with the database
+
+        Parameters
+        ----------
+        force : bool, optional
+            Discard the local copy and page through the whole table again
+        """
+        with self._lock:
+            if force or self.last_sync is None:
+                items = self.store.fetch_all()
+                self._records = {}
+                self._search_index = PromptIndex()
+                self._hashes = {}
+                self._hash_tree = BKTree()
+                self._df = None
+                self.high_water = None
+            elif time.monotonic() - self.last_sync < self.sync_interval:
+                return
+            else:
+                items = self.store.fetch_since(self.high_water) if self.high_water else self.store.fetch_all()
+            self._merge(items)
+            self.last_sync = time.monotonic()
+
+    def add(self, record):
+        """
+        Add a record that was just written to the store, as returned by `put`
+        """
+        with self._lock:
+            self._merge([record])
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._records
+
+    def search(self, query, limit=50, offset=0):
+        """
+        Full-text search over the prompts, see `PromptIndex.search`
+
+        Returns
+        -------
+        (list of str, int)
+            The record keys on the requested page, best match first, and the total number of matches
+        """
+        with self._lock:
+            return self._search_index.search(query, limit=limit, offset=offset)
+
+    def similar(self, key, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        Records whose image looks like the image of `key`
+
+        Returns
+        -------
+        list of str
+            Keys of the near-duplicates, closest first, not including `key`.
+            Empty if `key` has no perceptual hash
+        """
+        with self._lock:
+            value = self._hashes.get(key)
+            if value is None:
+                return []
+            return [match for _, match in self._hash_tree.search(value, max_distance) if match != key]
+
+    def collapse(self, keys, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        Keep the first record of each group of near-duplicates among `keys`, see `similarity.collapse`
+        """
+        with self._lock:
+            return collapse(keys, self._hashes, max_distance)
+
+    def dataframe(self, keys=None):
+        """
+        Parameters
+        ----------
+        keys : list of str, optional
+            Only include these records, in this order
+
+        Returns
+        -------
+        pd.DataFrame
+            The gallery records. The full table is rebuilt only when the records have changed since the last call
+        """
+        with self._lock:
+            if keys is not None:
+                records = [self._records[key] for key in keys if key in self._records]
+                return pd.DataFrame(records) if records else pd.DataFrame(columns=GALLERY_COLUMNS)
+            if self._df is None:
+                records = list(self._records.values())
+                self._df = pd.DataFrame(records) if records else pd.DataFrame(columns=GALLERY_COLUMNS)
+            return self._df
+
+    def _merge(self, items):
+        changed = False
+        for item in items:
+            if self._records.get(item['key']) != item:
+                self._records[item['key']] = item
+                self._search_index.add(item['key'], item.get('prompt'))
+                if item.get('phash') and item['key'] not in self._hashes:
+                    self._hashes[item['key']] = int(item['phash'], 16)
+                    self._hash_tree.add(self._hashes[item['key']], item['key'])
+                changed = True
+            if item.get('date') and (self.high_water is None or item['date'] > self.high_water):
+                self.high_water = item['date']
+        if changed:
+            self._df = None
@@ -0,0 +1,194 @@
+import base64
+import functools
+import random
+import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from clients import HTTP_TIMEOUT
+from lazy import lazy_import, ensure_loaded
+from metrics import timed
+
+# The OpenAI client takes about a second to import, it is only loaded once an image is requested
+openai = lazy_import('openai')
+
+# Maximum number of generation requests or downloads in flight at once
+DEFAULT_BATCH_WORKERS = 4
+# 'b64_json' returns the images inside the API response, 'url' returns links that need a second request
+DEFAULT_RESPONSE_FORMAT = 'b64_json'
+# Size of the reads when an image is downloaded from its URL
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Retries for rate limits and transient API errors, with exponential backoff starting at BACKOFF_BASE seconds
+MAX_RETRIES = 5
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors():
+    """
+    Errors worth retrying, anything else (e.g. a rejected prompt) fails the job straight away
+
+    The first call imports the OpenAI client, it is safe to make from several threads at once.
+    """
+    ensure_loaded(openai)
+    return (openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+            openai.error.APIError)
+
+
+def download_image(url, http_session=None):
+    """
+    Download one generated image
+
+    Parameters
+    ----------
+    url : str
+        Image URL from the response
+    http_session : requests.Session, optional
+        Pooled session to reuse connections, a one-off connection is made if not specified
+
+    Returns
+    -------
+    bytes
+        The encoded image
+    """
+    # Read the body in chunks as it arrives instead of buffering the whole response first
+    with timed('http.download') as span, (http_session or requests).get(url, timeout=HTTP_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        buffer = BytesIO()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        span.nbytes = buffer.tell()
+        return buffer.getvalue()
+
+
+def response_images(response, http_session=None, max_workers=DEFAULT_BATCH_WORKERS):
+    """
+    Encoded images of an image API response, whichever response format it used
+
+    Images sent inline as base64 are decoded directly. Images sent as URLs are
+    downloaded, which is also the fallback when an item has no inline data.
+
+    Parameters
+    ----------
+    response : dict
+        Response of openai.Image.create, create_variation or create_edit
+    http_session : requests.Session, optional
+        Pooled session used for the URL downloads
+    max_workers : int, optional
+        Upper bound on downloads in flight
+
+    Returns
+    -------
+    list of bytes
+        The encoded images, in the order of the response
+    """
+    with timed('openai.decode') as span:
+        images = [base64.b64decode(item['b64_json']) if item.get('b64_json') else None for item in response['data']]
+        span.nbytes = sum(len(image) for image in images if image is not None)
+    missing = [i for i, image in enumerate(images) if image is None]
+    if missing:
+        downloads = download_images([response['data'][i]['url'] for i in missing], http_session, max_workers)
+        for i, data in zip(missing, downloads):
+            images[i] = data
+    return images
+
+
+def generate_image(prompt, size="1024x1024", http_session=None, response_format=DEFAULT_RESPONSE_FORMAT):
+    """
+    Generate one image from a prompt
+
+    Parameters
+    ----------
+    prompt : str
+        The prompt to use to generate the image
+    size : str, optional
+        Size requested from the API
+    http_session : requests.Session, optional
+        Pooled session used when the image has to be downloaded
+    response_format : str, optional
+        'b64_json' to receive the image in the response, 'url' to download it afterwards
+
+    Returns
+    -------
+    (bytes, int)
+        The encoded image and the `created` timestamp of the response, used as its id
+    """
+    with timed('openai.image'):
+        response = openai.Image.create(prompt=prompt, n=1, size=size, response_format=response_format)
+    return response_images(response, http_session)[0], response['created']
+
+
+def download_images(urls, http_session=None, max_workers=DEFAULT_BATCH_WORKERS):
+    """
+    Download the images returned by the API concurrently
+
+    Parameters
+    ----------
+    urls : list of str
+        Image URLs from the response
+    http_session : requests.Session, optional
+        Pooled session shared by the downloads
+    max_workers : int, optional
+        Upper bound on downloads in flight
+
+    Returns
+    -------
+    list of bytes
+        The encoded images, in the same order as `urls`
+    """
+    def download(url):
+        return download_image(url, http_session)
+
+    if len(urls) <= 1:
+        return [download(url) for url in urls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        return list(executor.map(download, urls))
+
+
+def retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying after `error`, honouring the Retry-After header of rate limit responses
+    """
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    # Exponential backoff with full jitter so parallel jobs do not retry in lockstep
+    return random.uniform(0, min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+
+
+def call_with_retries(fn, *args, max_retries=MAX_RETRIES, on_retry=None, **kwargs):
+    """
+    Call `fn`, retrying rate limits and transient API errors with backoff
+
+    Parameters
+    ----------
+    fn : callable
+        Function to call with `args` and `kwargs`
+    max_retries : int, optional
+        Number of retries before the last error is raised
+    on_retry : callable, optional
+        Called as on_retry(attempt, delay, error) before each wait
+
+    Returns
+    -------
+    Whatever `fn` returns
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except retryable_errors() as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            if on_retry is not None:
+                on_retry(attempt + 1, delay, e)
+            time.sleep(delay)
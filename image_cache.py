@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+
+# Default memory budget for the gallery cache, in bytes
+DEFAULT_BUDGET_BYTES = 256 * 1024 * 1024
+
+
+def image_nbytes(image):
+    """
+    Estimate the memory used by a decoded PIL image
+
+    Parameters
+    ----------
+    image : PIL image
+        The image to measure
+
+    Returns
+    -------
+    int
+        Approximate size of the pixel data in bytes
+    """
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded images with a memory budget in bytes.
+
+    Entries are stored per S3 key together with the ETag of the object they were
+    decoded from. A lookup that passes an ETag only hits if it matches, and a lookup
+    without one trusts the stored entry, which is what lets a repeat gallery view
+    skip S3 entirely. Anything that overwrites an object must call `invalidate`.
+    """
+
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES, sizeof=image_nbytes):
+        self.budget_bytes = budget_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (etag, value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, etag=None):
+        """
+        Return the cached value for `key`, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (etag is not None and entry[0] != etag):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, etag=None):
+        """
+        Store `value` for `key`, evicting least recently used entries to stay in budget
+
+        Values larger than the whole budget are not stored.
+        """
+        nbytes = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if nbytes > self.budget_bytes:
+                return
+            self._entries[key] = (etag, value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.budget_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drop any cached value for `key`, called after the object is uploaded or replaced
+        """
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            Hit/miss/eviction counters, number of entries and bytes in use
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._nbytes,
+                    'budget_bytes': self.budget_bytes}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
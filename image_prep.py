@@ -0,0 +1,71 @@
+from io import BytesIO
+from PIL import Image
+from metrics import timed
+
+# Size of the images sent to the variation and edit endpoints
+TARGET_SIZE = (1024, 1024)
+# zlib level used for PNGs sent to the API, level 1 is several times faster than the default and only slightly bigger
+PNG_COMPRESS_LEVEL = 1
+# Attribute holding the PNG encodings of an image, by size
+_ENCODED_ATTR = '_encoded_png'
+
+
+def open_image(data, draft_size=TARGET_SIZE):
+    """
+    Decode image bytes, remembering them so an unchanged PNG is never encoded again
+
+    Parameters
+    ----------
+    data : bytes
+        Encoded image, e.g. an upload or an API result
+    draft_size : (int, int), optional
+        For JPEGs, decode at the smallest scale that is still at least this size.
+        None to always decode at full size
+
+    Returns
+    -------
+    PIL.Image
+        The image, decoded lazily
+    """
+    image = Image.open(BytesIO(data))
+    if image.format == 'PNG':
+        setattr(image, _ENCODED_ATTR, {image.size: data})
+    elif image.format == 'JPEG' and draft_size is not None:
+        # Big photos are decoded at 1/2, 1/4 or 1/8 scale instead of being resized after a full decode
+        image.draft('RGB', draft_size)
+    return image
+
+
+def encode_png(image, size=None):
+    """
+    PNG bytes of an image at `size`, encoding it at most once per size
+
+    Images opened with `open_image` from a PNG return their original bytes when no
+    resize is needed. Other encodings are cached on the image object, so chained
+    variation and edit requests on the same image reuse them.
+
+    Parameters
+    ----------
+    image : PIL image
+        The image to encode
+    size : (int, int), optional
+        Resize to this size first, unless the image already has it. Current size if not specified
+
+    Returns
+    -------
+    bytes
+        The PNG
+    """
+    size = tuple(size) if size is not None else image.size
+    encoded = getattr(image, _ENCODED_ATTR, None)
+    if encoded is None:
+        encoded = {}
+        setattr(image, _ENCODED_ATTR, encoded)
+    if size not in encoded:
+        with timed('pil.encode') as span:
+            resized = image if image.size == size else image.resize(size)
+            byte_stream = BytesIO()
+            resized.save(byte_stream, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+            span.nbytes = byte_stream.tell()
+        encoded[size] = byte_stream.getvalue()
+    return encoded[size]
@@ -10,7 +10,158 @@ from pandas.api.types import (
 	is_object_dtype,
 )
 
-def aggrid_multi_select(df: pd.DataFrame, website = None, list_of_text = None):
+def page_dataframe(df: pd.DataFrame, page: int, page_size: int, sort_by = None, ascending = True, filter_text = None):
+	"""
+	Filters, sorts and slices a dataframe on the server so only one page is sent to the browser.
+	----
+	Parameters:
+	----------
+	df: pd.DataFrame
+		Full dataframe
+	page: int
+		Page number, starting at 1
+	page_size: int
+		Number of rows per page
+	sort_by: str
+		Column to sort by, original order if None
+	ascending: bool
+		Sort direction
+	filter_text: str
+		Keep only rows where a text column contains this text (case insensitive)
+
+	Returns:
+	--------
+	page_df: pd.DataFrame
+		Rows on the requested page, with a fresh 0-based index
+	total_rows: int
+		Number of rows after filtering
+	"""
+	df = _filter_and_sort(df, sort_by, ascending, filter_text)
+	return _page(df, page, page_size), len(df)
+
+
+def _filter_and_sort(df: pd.DataFrame, sort_by = None, ascending = True, filter_text = None):
+	"""
+	The rows of `df` in table order, see `page_dataframe`.
+	"""
+	if filter_text:
+		text_columns = [column for column in df.columns if is_object_dtype(df[column])]
+		mask = pd.Series(False, index=df.index)
+		for column in text_columns:
+			mask |= df[column].astype(str).str.contains(filter_text, case=False, regex=False)
+		df = df[mask]
+	if sort_by is not None:
+		# Text columns can hold mixed types (e.g. numeric and 'Manual' ids), compare them as strings
+		df = df.sort_values(sort_by, ascending=ascending, kind="stable",
+				key=lambda col: col.astype(str) if is_object_dtype(col) else col)
+	return df
+
+
+def _page(df: pd.DataFrame, page: int, page_size: int):
+	start = (page - 1) * page_size
+	return df.iloc[start:start + page_size].reset_index(drop=True)
+
+
+def _paged_controls(df: pd.DataFrame, page_size: int, key: str):
+	"""
+	Renders the filter, sort and page widgets for a paged table and returns the current page.
+	"""
+	filter_col, sort_col, order_col, page_col = st.columns([3, 2, 1, 1])
+	filter_text = filter_col.text_input("Filter", key=f"{key}_filter")
+	sort_by = sort_col.selectbox("Sort by", [None] + list(df.columns), key=f"{key}_sort_by",
+				format_func=lambda column: "(none)" if column is None else column)
+	ascending = order_col.selectbox("Order", ["asc", "desc"], key=f"{key}_order") == "asc"
+	page = st.session_state.get(f"{key}_page", 1)
+	df = _filter_and_sort(df, sort_by, ascending, filter_text)
+	total_rows = len(df)
+	num_pages = max(1, -(-total_rows // page_size))
+	if page > num_pages:
+		# The filter left fewer pages than before, jump to the last one
+		page = st.session_state[f"{key}_page"] = num_pages
+	page_col.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, step=1, key=f"{key}_page")
+	st.caption(f"{total_rows} rows")
+	# Remember this page and the next one, in the same order, for `upcoming_rows`
+	page_df = _page(df, page, page_size)
+	st.session_state[f"{key}_page_df"] = page_df
+	st.session_state[f"{key}_next_page_df"] = _page(df, page + 1, page_size)
+	return page_df
+
+
+def upcoming_rows(key: str, limit: int):
+	"""
+	Rows a user is likely to select next in a paged table, for prefetching.
+	----
+	Parameters:
+	----------
+	key: str
+		Widget key of a table shown with `page_size`
+	limit: int
+		Maximum number of rows returned
+
+	Returns:
+	--------
+	rows_df: pd.DataFrame
+		The rows after the last selected row of the current page, then the rows of the
+		next page, in the table's current sort order. Selected rows are not included
+	"""
+	page_df = st.session_state.get(f"{key}_page_df")
+	if page_df is None:
+		return pd.DataFrame()
+	selected = st.session_state.get(f"{key}_selected", {})
+	is_selected = page_df["key"].isin(list(selected))
+	start = is_selected[is_selected].index[-1] + 1 if is_selected.any() else 0
+	rows_df = pd.concat([page_df.iloc[start:], st.session_state[f"{key}_next_page_df"]], ignore_index=True)
+	return rows_df[~rows_df["key"].isin(list(selected))].head(limit)
+
+
+def _pre_selected_rows(key: str, page_df: pd.DataFrame):
+	"""
+	Positions of the rows on the current page that were selected earlier, so the grid shows them checked.
+	"""
+	selected = st.session_state.get(f"{key}_selected", {})
+	return [i for i, row_key in enumerate(page_df["key"]) if row_key in selected]
+
+
+def _track_selection(key: str, page_df: pd.DataFrame, sel_row, multiple: bool):
+	"""
+	Keeps the rows selected on every page in session state, identified by their `key` column.
+	Rows of the previously rendered page that are no longer selected are dropped.
+	"""
+	selected = st.session_state.setdefault(f"{key}_selected", {})
+	# A list of row dicts in older streamlit-aggrid releases, None or a DataFrame in 1.x
+	rows = [] if sel_row is None else pd.DataFrame(sel_row).to_dict("records")
+	returned_keys = {row["key"] for row in rows}
+	for row_key in st.session_state.get(f"{key}_page_keys", []):
+		if row_key not in returned_keys:
+			selected.pop(row_key, None)
+	if not multiple and returned_keys:
+		selected.clear()
+	for record in page_df.to_dict("records"):
+		if record["key"] in returned_keys:
+			selected[record["key"]] = record
+	st.session_state[f"{key}_page_keys"] = page_df["key"].tolist()
+	return pd.DataFrame(list(selected.values()), columns=page_df.columns)
+
+
+def current_page(key: str):
+	"""
+	Rows shown on the current page of a paged table.
+	----
+	Parameters:
+	----------
+	key: str
+		Widget key of a table shown with `page_size`
+
+	Returns:
+	--------
+	page_df: pd.DataFrame
+		The rows of the page, empty before the table is first shown
+	"""
+	page_df = st.session_state.get(f"{key}_page_df")
+	return page_df if page_df is not None else pd.DataFrame()
+
+
+def aggrid_multi_select(df: pd.DataFrame, website = None, list_of_text = None, page_size = None, key = "aggrid_multi_select"):
 	"""
 	Creates an st-aggrid interactive table based on a dataframe.
 	Return a dataframe with the selected rows.
@@ -24,12 +175,19 @@ def aggrid_multi_select(df: pd.DataFrame, website = None, list_of_text = None):
 	list_of_text: list
 		List of part numbers to highlight their corresponding rows a light green color.
 		This is used for showing what parts have already been added to the database.
+	page_size: int
+		If set, only one page of rows is sent to the browser. Filtering, sorting and paging
+		are done on the server and the selection is kept across pages by the `key` column.
+	key: str
+		Widget key, must be unique when several tables are shown
 	
 	Returns:
 	--------
 	df_sel_row: pd.DataFrame
 		Dataframe with the rows selected by the user on interactive table.
 	"""
+	if page_size is not None:
+		df = _paged_controls(df, page_size, key)
 	# gd.configure_pagination(enabled=True)
 	gd = GridOptionsBuilder.from_dataframe(df)#, min_column_width=150)
 	gd.configure_side_bar() #Add a sidebar
@@ -57,6 +215,7 @@ def aggrid_multi_select(df: pd.DataFrame, website = None, list_of_text = None):
 				groupSelectsChildren=True,
 				groupSelectsFiltered=True,
 				rowMultiSelectWithClick=True, 
+				pre_selected_rows=_pre_selected_rows(key, df) if page_size is not None else None,
 				# suppressColumnExpandAll = True,
 				)
 	gridoptions = gd.build()
@@ -70,25 +229,31 @@ def aggrid_multi_select(df: pd.DataFrame, website = None, list_of_text = None):
 			update_mode=GridUpdateMode.SELECTION_CHANGED,
 			columns_auto_size_mode=ColumnsAutoSizeMode.FIT_CONTENTS,
 			enable_enterprise_modules=False,
+			key=key,
 			# allow_unsafe_jscode=True,
 			# theme="material"
 			)
 
 	sel_row = grid_table["selected_rows"]
 	# node_id = grid_table["selected_row_ids"]
+	if page_size is not None:
+		return _track_selection(key, df, sel_row, multiple=True)
 	df_sel_row = pd.DataFrame(sel_row)
 	return df_sel_row
 
 
-def aggrid_single_select(df: pd.DataFrame, website = None):
+def aggrid_single_select(df: pd.DataFrame, website = None, page_size = None, key = "aggrid_single_select"):
 	"""
 	Creates an st-aggrid interactive table based on a dataframe.
 	Return a dataframe with the selected rows
+	With `page_size` set, the table is paged on the server like `aggrid_multi_select`.
 	"""
 	with warnings.catch_warnings():
 		warnings.simplefilter(action='ignore', category=FutureWarning)
+		if page_size is not None:
+			df = _paged_controls(df, page_size, key)
 		gd = GridOptionsBuilder.from_dataframe(df)#, min_column_width=150)
-		gd.configure_pagination(enabled=True)
+		gd.configure_pagination(enabled=page_size is None)
 		gd.configure_side_bar() #Add a sidebar
 		gd.configure_default_column(
 					groupable=True, 
@@ -114,6 +279,7 @@ def aggrid_single_select(df: pd.DataFrame, website = None):
 					groupSelectsChildren=True,
 					groupSelectsFiltered=True,
 					rowMultiSelectWithClick=True, 
+					pre_selected_rows=_pre_selected_rows(key, df) if page_size is not None else None,
 					# suppressColumnExpandAll = True,
 					)
 		gridoptions = gd.build()
@@ -126,10 +292,13 @@ def aggrid_single_select(df: pd.DataFrame, website = None):
 				update_mode=GridUpdateMode.SELECTION_CHANGED,
 				columns_auto_size_mode=ColumnsAutoSizeMode.FIT_CONTENTS,
 				enable_enterprise_modules=False,
+				key=key,
 				# theme="material"
 				)
 
 		sel_row = grid_table["selected_rows"]
 		# node_id = grid_table["selected_row_ids"]
+		if page_size is not None:
+			return _track_selection(key, df, sel_row, multiple=False)
 		df_sel_row = pd.DataFrame(sel_row)
 	return df_sel_row
@@ -0,0 +1,545 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from content_store import put_content, put_many_content, expire_results, RESULTS_PREFIX
+from generation import generate_image, response_images, call_with_retries, retryable_errors, openai, DEFAULT_BATCH_WORKERS, DEFAULT_RESPONSE_FORMAT, MAX_RETRIES
+from image_prep import open_image
+from metrics import timed
+from response_cache import request_key, hash_bytes
+from similarity import dhash
+from thumbnails import upload_thumbnails
+from transfers import download_bytes
+
+# Default location of the job queue database, shared by the app and the workers
+DEFAULT_QUEUE_PATH = 'jobs.db'
+# Jobs run at the same time by one worker
+DEFAULT_JOB_WORKERS = DEFAULT_BATCH_WORKERS
+# Seconds a claimed job is reserved for its worker, a job still running after that is taken over by another one
+DEFAULT_LEASE = 600
+# A job whose worker went away this many times is failed instead of being taken over again
+MAX_ATTEMPTS = 3
+# Seconds between two checks of the queue when it is empty
+DEFAULT_POLL_INTERVAL = 0.5
+# Longest wait before trying the queue again after it raised, the wait doubles from the poll interval
+MAX_ERROR_BACKOFF = 30.0
+# Finished jobs are kept this many seconds, so their results can still be found after a reconnect
+DEFAULT_KEEP = 7 * 24 * 60 * 60
+# Kinds of job a worker knows how to run
+JOB_KINDS = ('generate', 'variation', 'edit', 'save')
+
+
+class JobQueue:
+    """
+    Persistent queue of generation and save jobs in a SQLite file.
+
+    The app enqueues jobs and reads their status, workers in this or other processes
+    claim and run them. A job holds JSON parameters and optional binary inputs
+    (images, masks); its result is a small JSON document with the S3 keys of the
+    images it produced, never the bytes themselves. Claims are leases, so the jobs
+    of a worker that stopped are picked up by the next one.
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH, lease=DEFAULT_LEASE, keep=DEFAULT_KEEP):
+        self.path = path
+        self.lease = lease
+        self.keep = keep
+        self._lock = threading.Lock()
+        # Autocommit, transactions are opened explicitly so a claim can lock the database for writing up front
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        # WAL lets the app read statuses while a worker process writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY, owner TEXT, kind TEXT NOT NULL, params TEXT NOT NULL, "
+                               "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, message TEXT, result TEXT, "
+                               "created REAL NOT NULL, updated REAL NOT NULL, lease_until REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS job_inputs ("
+                               "job_id TEXT, position INTEGER, data BLOB NOT NULL, PRIMARY KEY (job_id, position))")
+
+    def enqueue(self, owner, kind, params, inputs=()):
+        """
+        Add a job, dropping finished jobs older than `keep`
+
+        Parameters
+        ----------
+        owner : str
+            Session the job belongs to
+        kind : str
+            One of JOB_KINDS
+        params : dict
+            JSON-serializable parameters of the job
+        inputs : list of bytes, optional
+            Encoded images the job works on
+
+        Returns
+        -------
+        str
+            Id of the job
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Invalid job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._transaction():
+            self._conn.execute("INSERT INTO jobs (id, owner, kind, params, status, created, updated) "
+                               "VALUES (?, ?, ?, ?, 'queued', ?, ?)", (job_id, owner, kind, json.dumps(params), now, now))
+            self._conn.executemany("INSERT INTO job_inputs (job_id, position, data) VALUES (?, ?, ?)",
+                                   [(job_id, position, data) for position, data in enumerate(inputs)])
+            self._conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (now - self.keep,))
+        return job_id
+
+    def claim(self):
+        """
+        Take the oldest job waiting to run, or one whose worker let its lease expire
+
+        Returns
+        -------
+        dict or None
+            The job with its inputs, None if there is nothing to run
+        """
+        now = time.time()
+        with self._lock, self._transaction('IMMEDIATE'):
+            while True:
+                row = self._conn.execute("SELECT id, attempts FROM jobs WHERE status = 'queued' "
+                                         "OR (status = 'running' AND lease_until < ?) ORDER BY created LIMIT 1",
+                                         (now,)).fetchone()
+                if row is None:
+                    return None
+                if row[1] >= MAX_ATTEMPTS:
+                    self._finish(row[0], 'failed', message='The worker stopped while running this job', now=now)
+                    continue
+                self._conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, message = NULL, "
+                                   "updated = ?, lease_until = ? WHERE id = ?", (now, now + self.lease, row[0]))
+                job = self._get([row[0]])[0]
+                job['inputs'] = [data for data, in self._conn.execute(
+                    "SELECT data FROM job_inputs WHERE job_id = ? ORDER BY position", (row[0],))]
+                return job
+
+    def note(self, job_id, message):
+        """
+        Show a progress message on a running job (e.g. a retry) and renew its lease
+        """
+        now = time.time()
+        with self._lock, self._transaction():
+            self._conn.execute("UPDATE jobs SET message = ?, updated = ?, lease_until = ? WHERE id = ? AND status = 'running'",
+                               (message, now, now + self.lease, job_id))
+
+    def complete(self, job_id, result):
+        """
+        Mark a job as done with its JSON-serializable result
+        """
+        with self._lock, self._transaction():
+            self._finish(job_id, 'done', result=result)
+
+    def fail(self, job_id, message):
+        with self._lock, self._transaction():
+            self._finish(job_id, 'failed', message=message)
+
+    def get(self, job_ids):
+        """
+        Returns
+        -------
+        list of dict
+            The jobs with these ids that still exist, in the same order, without their inputs
+        """
+        with self._lock:
+            return self._get(job_ids)
+
+    def recent(self, owner, limit=20):
+        """
+        Returns
+        -------
+        list of dict
+            The latest jobs of `owner`, newest first, without their inputs
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM jobs WHERE owner = ? ORDER BY created DESC LIMIT ?",
+                                      (owner, limit)).fetchall()
+            return self._get([row[0] for row in rows])
+
+    def unfinished(self, owner):
+        """
+        Returns
+        -------
+        list of str
+            Ids of the queued and running jobs of `owner`, oldest first, however many there are
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM jobs WHERE owner = ? AND status IN ('queued', 'running') "
+                                      "ORDER BY created", (owner,)).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self):
+        """
+        Returns
+        -------
+        dict
+            Number of jobs by status
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def _get(self, job_ids):
+        if not job_ids:
+            return []
+        rows = self._conn.execute("SELECT id, owner, kind, params, status, attempts, message, result, created, updated "
+                                  f"FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})", list(job_ids)).fetchall()
+        jobs = {row[0]: {'id': row[0],
+                         'owner': row[1],
+                         'kind': row[2],
+                         'params': json.loads(row[3]),
+                         'status': row[4],
+                         'attempts': row[5],
+                         'message': row[6],
+                         'result': json.loads(row[7]) if row[7] is not None else None,
+                         'created': row[8],
+                         'updated': row[9]} for row in rows}
+        return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+    def _finish(self, job_id, status, result=None, message=None, now=None):
+        self._conn.execute("UPDATE jobs SET status = ?, result = ?, message = ?, updated = ?, lease_until = NULL WHERE id = ?",
+                           (status, json.dumps(result) if result is not None else None, message, now or time.time(), job_id))
+        # Inputs are only needed to run the job
+        self._conn.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+
+    @contextmanager
+    def _transaction(self, mode='DEFERRED'):
+        self._conn.execute(f"BEGIN {mode}")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+class JobWorker:
+    """
+    Runs the jobs of a queue with its own thread pool, outside of any Streamlit script.
+
+    Generation calls are retried on rate limits and transient API errors, and the
+    resulting images are stored in the bucket under their content keys. Saved images
+    also get their thumbnails and a gallery record. One worker can run inside the app
+    process (see `start`), or any number of them as separate processes (`python jobs.py`).
+    """
+
+    def __init__(self, queue, s3_client, bucket, metadata_store, response_cache, http_session=None,
+                 transfer_config=None, response_format=DEFAULT_RESPONSE_FORMAT, max_workers=DEFAULT_JOB_WORKERS,
+                 poll_interval=DEFAULT_POLL_INTERVAL, max_retries=MAX_RETRIES):
+        self.queue = queue
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.metadata_store = metadata_store
+        self.response_cache = response_cache
+        self.http_session = http_session
+        self.transfer_config = transfer_config
+        self.response_format = response_format
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self._handlers = {'generate': self.generate,
+                          'variation': self.variation,
+                          'edit': self.edit,
+                          'save': self.save}
+
+    def run(self, stop=None):
+        """
+        Claim and run jobs until `stop` is set, with at most `max_workers` running at once
+
+        Parameters
+        ----------
+        stop : threading.Event, optional
+            Set it to stop claiming jobs, the running ones are finished first
+        """
+        stop = stop or threading.Event()
+        running = set()
+        backoff = self.poll_interval
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not stop.is_set():
+                running = {future for future in running if not future.done()}
+                try:
+                    job = self.queue.claim() if len(running) < self.max_workers else None
+                except Exception:
+                    # e.g. the database stayed locked, the worker must outlive it or queued jobs would never run
+                    logging.exception("Could not claim a job, retrying in %.1fs", backoff)
+                    stop.wait(backoff)
+                    backoff = min(backoff * 2, MAX_ERROR_BACKOFF)
+                    continue
+                backoff = self.poll_interval
+                if job is None:
+                    stop.wait(self.poll_interval)
+                    continue
+                running.add(executor.submit(self.run_job, job))
+
+    def start(self):
+        """
+        Run the worker on a daemon thread of the current process
+
+        Returns
+        -------
+        threading.Event
+            Set it to stop the worker
+        """
+        stop = threading.Event()
+        threading.Thread(target=self.run, args=(stop,), name='job-worker', daemon=True).start()
+        return stop
+
+    def run_job(self, job):
+        """
+        Run one claimed job and record its result or error on the queue
+
+        Errors are logged rather than raised, nothing reads the futures of the job threads.
+        A job whose outcome could not be recorded is run again once its lease expires.
+        """
+        try:
+            result = self._handlers[job['kind']](job)
+        except Exception as e:
+            logging.exception("Job %s (%s) failed", job['id'], job['kind'])
+            self._record(self.queue.fail, job, f"{type(e).__name__}: {e}")
+        else:
+            # e.g. a result that cannot be stored, fail the job instead of leaving it running
+            if not self._record(self.queue.complete, job, result):
+                self._record(self.queue.fail, job, 'The result of the job could not be stored')
+
+    def _record(self, method, job, value):
+        """
+        Call `method` (complete or fail) of the queue for `job`, logging instead of raising
+
+        Returns
+        -------
+        bool
+            Whether the queue was updated
+        """
+        try:
+            method(job['id'], value)
+        except Exception:
+            logging.exception("Could not record the outcome of job %s", job['id'])
+            return False
+        return True
+
+    def generate(self, job):
+        """
+        Generate an image from params['prompt'], saving it to the gallery if params['save'] is set
+
+        Returns
+        -------
+        dict
+            'id' of the response, 'keys' of the stored image and the gallery 'records' written
+        """
+        params = job['params']
+        # Identical prompts are served from the image stored by the first request. The jobs of a batch
+        # repeat a prompt on purpose to get different images, so they never use the cache
+        use_cache = params.get('index') is None
+        request = request_key(model="dall-e", prompt=params['prompt'], size="1024x1024", n=1)
+        cached = self.response_cache.get(request) if use_cache and not params.get('fresh') else None
+        s = None
+        if cached is not None and params.get('save') and cached['keys'][0].startswith(RESULTS_PREFIX):
+            # The image was only displayed so far, save it instead of generating another one
+            try:
+                s = download_bytes(self.s3_client, self.bucket, cached['keys'][0], config=self.transfer_config)
+                unique_id = cached['id']
+            except ClientError as e:
+                logging.warning("Cached result %s is gone, generating again: %s", cached['keys'][0], e)
+        elif cached is not None:
+            return {'id': cached['id'], 'keys': cached['keys'], 'records': []}
+
+        if s is None:
+            s, unique_id = self._call(job, generate_image, params['prompt'], http_session=self.http_session,
+                                      response_format=self.response_format)
+        if params.get('index') is not None:
+            # Images of a batch are often created in the same second, the index keeps their ids apart
+            unique_id = f"{unique_id}-{params['index']}"
+        if not params.get('save'):
+            # Only stored for the app to display, under the prefix the bucket expires. Saving it later
+            # uploads it again under its gallery key
+            file_name, _ = put_content(self.s3_client, s, self.bucket, config=self.transfer_config,
+                                       prefix=RESULTS_PREFIX)
+            if use_cache:
+                self.response_cache.put(request, {'id': unique_id, 'keys': [file_name]})
+            return {'id': unique_id, 'keys': [file_name], 'records': []}
+
+        image = open_image(s)
+        records = self._save([s], [image], [params['prompt']], lambda digest: unique_id)
+        if use_cache:
+            self.response_cache.put(request, {'id': unique_id, 'keys': [records[0]['image']]})
+        return {'id': unique_id, 'keys': [records[0]['image']], 'records': records}
+
+    def variation(self, job):
+        """
+        Create params['n'] variations of the input image, a 1024x1024 PNG
+
+        Returns
+        -------
+        dict
+            'id' of the response and 'keys' of the stored images
+        """
+        params = job['params']
+        image, = job['inputs']
+        # Identical requests are served from the images stored by the first one
+        request = request_key(model="dall-e-variation", image=hash_bytes(image), size="1024x1024", n=params['n'])
+        cached = None if params.get('fresh') else self.response_cache.get(request)
+        if cached is not None:
+            return {'id': cached['id'], 'keys': cached['keys']}
+
+        def create_variation():
+            with timed('openai.variation'):
+                return openai.Image.create_variation(image=image, n=params['n'], size="1024x1024",
+                                                     response_format=self.response_format)
+
+        response = self._call(job, create_variation)
+        return self._store_response(request, response)
+
+    def edit(self, job):
+        """
+        Edit the masked part of the input image following params['prompt'], the inputs are the image and the mask
+
+        Returns
+        -------
+        dict
+            'id' of the response and 'keys' of the stored images
+        """
+        params = job['params']
+        image, mask = job['inputs']
+        # Identical requests are served from the images stored by the first one
+        request = request_key(model="dall-e-edit", image=hash_bytes(image), mask=hash_bytes(mask),
+                              prompt=params['prompt'], size="1024x1024", n=params['n'])
+        cached = None if params.get('fresh') else self.response_cache.get(request)
+        if cached is not None:
+            return {'id': cached['id'], 'keys': cached['keys']}
+
+        def create_edit():
+            with timed('openai.edit'):
+                return openai.Image.create_edit(image=image, mask=mask, prompt=params['prompt'], n=params['n'],
+                                                size="1024x1024", response_format=self.response_format)
+
+        response = self._call(job, create_edit)
+        return self._store_response(request, response)
+
+    def save(self, job):
+        """
+        Save the input images to the gallery, with the prompts in params['prompts']
+
+        Images already in the bucket, e.g. the results the app displays, are given by their S3 keys
+        in params['keys'] instead, and come after the inputs in the order of the prompts.
+
+        Returns
+        -------
+        dict
+            'keys' of the stored images and the gallery 'records' written
+        """
+        downloads = list(job['inputs']) + [download_bytes(self.s3_client, self.bucket, key, config=self.transfer_config)
+                                           for key in job['params'].get('keys', [])]
+        images = [open_image(data) for data in downloads]
+        # The id starts with 'Manual' and ends with the start of the hash
+        records = self._save(downloads, images, job['params']['prompts'], lambda digest: 'Manual'+digest[:8])
+        return {'keys': [record['image'] for record in records], 'records': records}
+
+    def _call(self, job, fn, *args, **kwargs):
+        """
+        Call the API through `call_with_retries`, showing each retry on the job
+        """
+        # The first API job imports the OpenAI client, once, while the other job threads wait
+        retryable_errors()
+        def on_retry(attempt, delay, e):
+            self.queue.note(job['id'], f"Retry {attempt} in {delay:.0f}s ({type(e).__name__})")
+
+        return call_with_retries(fn, *args, max_retries=self.max_retries, on_retry=on_retry, **kwargs)
+
+    def _store_response(self, request, response):
+        # Decode the images sent in the response, or download every image returned at the same time
+        downloads = response_images(response, http_session=self.http_session)
+        # Only stored for the app to display, under the prefix the bucket expires
+        results = put_many_content(self.s3_client, downloads, self.bucket, config=self.transfer_config,
+                                   prefix=RESULTS_PREFIX)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        keys = [key for key, _ in results]
+        self.response_cache.put(request, {'id': response['created'], 'keys': keys})
+        return {'id': response['created'], 'keys': keys}
+
+    def _save(self, downloads, images, prompts, make_id):
+        """
+        Upload images under their content keys, with thumbnails when the bytes are new, and write their records
+
+        Returns
+        -------
+        list of dict
+            The records written, images that failed to upload are left out
+        """
+        date_string = datetime.date.today().strftime('%Y-%m-%d')
+        results = put_many_content(self.s3_client, downloads, self.bucket, config=self.transfer_config)
+        records = []
+        for image, prompt, result in zip(images, prompts, results):
+            if isinstance(result, Exception):
+                logging.error(result)
+                continue
+            file_name, uploaded = result
+            if uploaded:
+                upload_thumbnails(image, self.bucket, file_name, s3_client=self.s3_client)
+            # Keyed by the hash so the same image is recorded once
+            digest = file_name.split('.')[0]
+            records.append({'key': digest,
+                            'hash': digest,
+                            'id': make_id(digest),
+                            'date': date_string,
+                            'prompt': prompt,
+                            'image': file_name,
+                            'phash': dhash(image)})
+        if downloads and not records:
+            raise RuntimeError('None of the images could be uploaded')
+        return self.metadata_store.put_many(records)
+
+
+if __name__ == '__main__':
+    # Run jobs enqueued by the app in a separate process, as many of these as needed:
+    #   OPENAI_API_KEY=... DETA_KEY=... python jobs.py --queue jobs.db --workers 8
+    # The app then only enqueues, set START_JOB_WORKER = false in its secrets.
+    # The worker only makes API calls, import the OpenAI client before the first job comes in
+    from clients import create_s3_client, create_http_session
+    from content_store import DEFAULT_RESULTS_EXPIRATION_DAYS
+    from metadata_store import create_store, DEFAULT_SQLITE_PATH
+    from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+    import transfers
+    parser = argparse.ArgumentParser(description='Run the generation and save jobs enqueued by the app')
+    parser.add_argument('--queue', default=DEFAULT_QUEUE_PATH, help='Job queue database, the one the app uses')
+    parser.add_argument('--workers', type=int, default=DEFAULT_JOB_WORKERS, help='Jobs run at the same time')
+    parser.add_argument('--backend', default='deta', choices=('deta', 'sqlite'), help='Metadata store of the gallery')
+    parser.add_argument('--sqlite', default=DEFAULT_SQLITE_PATH, help='SQLite database file, for the sqlite backend')
+    parser.add_argument('--bucket', default='luisappsbucket', help='Bucket the images are stored in')
+    parser.add_argument('--response-cache', default=DEFAULT_CACHE_PATH, help='Response cache database')
+    parser.add_argument('--response-format', default=DEFAULT_RESPONSE_FORMAT, choices=('b64_json', 'url'),
+                        help='How the API returns the images')
+    parser.add_argument('--expire-results-days', type=int,
+                        help='Set the lifecycle rule deleting displayed results after this many days, '
+                             f'e.g. {DEFAULT_RESULTS_EXPIRATION_DAYS}, once per bucket')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    retryable_errors()
+    s3_client = create_s3_client()
+    if args.expire_results_days:
+        expire_results(s3_client, args.bucket, days=args.expire_results_days)
+    worker = JobWorker(JobQueue(args.queue),
+                       s3_client,
+                       args.bucket,
+                       create_store(args.backend, deta_key=os.environ.get('DETA_KEY'), sqlite_path=args.sqlite),
+                       ResponseCache(path=args.response_cache),
+                       http_session=create_http_session(),
+                       transfer_config=transfers.create_transfer_config(),
+                       response_format=args.response_format,
+                       max_workers=args.workers)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,52 @@
+import importlib.util
+import sys
+import threading
+
+# The first use of a lazy module runs its import, which must not happen on two threads at once
+_LOAD_LOCK = threading.Lock()
+
+
+def lazy_import(name):
+    """
+    Import a module when one of its attributes is first used instead of now
+
+    Lets a heavy dependency only cost startup time in the sessions that use the
+    feature needing it. The first use must not happen on several threads at once,
+    call `ensure_loaded` before using the module from a thread that may race with others.
+
+    Parameters
+    ----------
+    name : str
+        Absolute module name
+
+    Returns
+    -------
+    module
+        The module itself if it is already imported, otherwise a module that finishes importing on first use
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def ensure_loaded(module):
+    """
+    Finish importing a module from `lazy_import`, on one thread at a time
+
+    Returns
+    -------
+    module
+        The module, fully imported
+    """
+    with _LOAD_LOCK:
+        # Any attribute access runs the pending import
+        module.__name__
+    return module
@@ -0,0 +1,149 @@
+import functools
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+# DALL-E edits are requested at this size, so masks are built directly at it
+MASK_SIZE = (1024, 1024)
+# Number of (spec, size) combinations kept in memory
+MASK_CACHE_SIZE = 64
+
+# The nine sections of the original 3x3 editor, as (row, column) cells
+SECTIONS = {'top-left': (0, 0), 'top-center': (0, 1), 'top-right': (0, 2),
+            'middle-left': (1, 0), 'middle-center': (1, 1), 'middle-right': (1, 2),
+            'bottom-left': (2, 0), 'bottom-center': (2, 1), 'bottom-right': (2, 2)}
+
+# A mask spec is a tuple of shapes, the edited area is their union. Shapes are tuples
+# so specs are hashable and can be memoized:
+#   ('grid', rows, cols, ((row, col), ...))  cells of an N x M grid
+#   ('rect', left, top, right, bottom)         fractions of the width and height
+#   ('brush', ((x, y), ...), radius)           stroke through points given as fractions,
+#                                              radius as a fraction of the width
+
+
+def section_spec(section):
+    """
+    Mask spec for one of the nine named sections, e.g. 'top-left'
+    """
+    if section not in SECTIONS:
+        raise ValueError("Invalid section")
+    return grid_spec(3, 3, [SECTIONS[section]])
+
+
+def grid_spec(rows, cols, cells):
+    """
+    Mask spec for any number of cells of a `rows` x `cols` grid
+    """
+    cells = tuple(sorted({(int(row), int(col)) for row, col in cells}))
+    for row, col in cells:
+        if not (0 <= row < rows and 0 <= col < cols):
+            raise ValueError(f"Cell {row},{col} is outside a {rows}x{cols} grid")
+    return (('grid', int(rows), int(cols), cells),)
+
+
+def rect_spec(left, top, right, bottom):
+    """
+    Mask spec for a rectangle, coordinates are fractions of the image size
+    """
+    return (('rect', float(left), float(top), float(right), float(bottom)),)
+
+
+def brush_spec(points, radius):
+    """
+    Mask spec for a freehand stroke through `points`, all given as fractions of the image size
+    """
+    return (('brush', tuple((float(x), float(y)) for x, y in points), float(radius)),)
+
+
+def parse_pairs(text, cast=float):
+    """
+    Parse space separated 'a,b' pairs, e.g. '0,0 1,2'
+    """
+    return [tuple(cast(value) for value in pair.split(',')) for pair in text.split()]
+
+
+def _edges(length, parts):
+    # Same boundaries as splitting into thirds with integer division, the last part takes the remainder
+    return [i * (length // parts) for i in range(parts)] + [length]
+
+
+def _paint_brush(alpha, points, radius):
+    height, width = alpha.shape
+    radius = radius * width
+    points = [(x * width, y * height) for x, y in points]
+    # A single point is a segment of length zero
+    segments = zip(points, points[1:]) if len(points) > 1 else [(points[0], points[0])]
+    for (ax, ay), (bx, by) in segments:
+        # Only look at the bounding box of the segment, grown by the radius
+        x0, x1 = int(max(min(ax, bx) - radius, 0)), int(min(max(ax, bx) + radius + 1, width))
+        y0, y1 = int(max(min(ay, by) - radius, 0)), int(min(max(ay, by) + radius + 1, height))
+        if x0 >= x1 or y0 >= y1:
+            continue
+        xs = np.arange(x0, x1)[None, :] + 0.5
+        ys = np.arange(y0, y1)[:, None] + 0.5
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        t = np.clip(((xs - ax) * dx + (ys - ay) * dy) / length, 0, 1) if length else 0
+        distance = (xs - (ax + t * dx)) ** 2 + (ys - (ay + t * dy)) ** 2
+        alpha[y0:y1, x0:x1][distance <= radius * radius] = 0
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def mask_alpha(spec, size=MASK_SIZE):
+    """
+    Build the alpha channel of an edit mask
+
+    Parameters
+    ----------
+    spec : tuple
+        Shapes to edit, see the spec helpers above
+    size : (int, int), optional
+        Width and height of the mask
+
+    Returns
+    -------
+    np.ndarray
+        Read-only uint8 array of shape (height, width), 0 where the image is edited and 255 elsewhere
+    """
+    width, height = size
+    alpha = np.full((height, width), 255, dtype=np.uint8)
+    for shape in spec:
+        kind = shape[0]
+        if kind == 'grid':
+            _, rows, cols, cells = shape
+            row_edges, col_edges = _edges(height, rows), _edges(width, cols)
+            for row, col in cells:
+                alpha[row_edges[row]:row_edges[row + 1], col_edges[col]:col_edges[col + 1]] = 0
+        elif kind == 'rect':
+            _, left, top, right, bottom = shape
+            alpha[round(top * height):round(bottom * height), round(left * width):round(right * width)] = 0
+        elif kind == 'brush':
+            _, points, radius = shape
+            if points:
+                _paint_brush(alpha, points, radius)
+        else:
+            raise ValueError(f"Invalid mask shape: {kind}")
+    # Cached arrays are shared, make sure nobody changes them in place
+    alpha.flags.writeable = False
+    return alpha
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def mask_png(spec, size=MASK_SIZE):
+    """
+    Encode an edit mask as the PNG expected by the API
+
+    Only the alpha channel matters to the API, so the mask does not depend on the
+    image being edited and is memoized per spec and size.
+
+    Returns
+    -------
+    bytes
+        RGBA PNG, transparent where the image is edited
+    """
+    width, height = size
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    rgba[..., 3] = mask_alpha(spec, size)
+    byte_stream = BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(byte_stream, format='PNG', compress_level=1)
+    return byte_stream.getvalue()
@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import secrets
+import sqlite3
+import threading
+from metrics import timed
+
+# Deta accepts at most this many items in a single put_many call
+DETA_PUT_MANY_LIMIT = 25
+# Default location of the SQLite database
+DEFAULT_SQLITE_PATH = 'gallery.db'
+
+
+class MetadataStore:
+    """
+    Interface for the database holding one record per saved image.
+
+    Records are dicts with at least 'key', 'id', 'date' (YYYY-MM-DD), 'prompt' and
+    'image' (the S3 object name). Backends generate a key when a record has none.
+    """
+
+    def put(self, record):
+        """
+        Insert or replace a record
+
+        Returns
+        -------
+        dict
+            The stored record, including its key
+        """
+        return self.put_many([record])[0]
+
+    def put_many(self, records):
+        """
+        Insert or replace several records in as few round-trips as the backend allows
+
+        Returns
+        -------
+        list of dict
+            The stored records, including their keys
+
+        Raises
+        ------
+        RuntimeError
+            If the backend did not write some of the records, the others may have been written
+        """
+        raise NotImplementedError
+
+    def fetch_all(self):
+        """
+        Returns
+        -------
+        list of dict
+            Every record in the store
+        """
+        raise NotImplementedError
+
+    def fetch_since(self, date):
+        """
+        Returns
+        -------
+        list of dict
+            Records dated on or after `date`
+        """
+        raise NotImplementedError
+
+    def query(self, date=None, prompt=None):
+        """
+        Records matching an exact date and/or an exact prompt
+
+        Returns
+        -------
+        list of dict
+            The matching records
+        """
+        raise NotImplementedError
+
+
+class DetaStore(MetadataStore):
+    """
+    Records stored in a Deta Base, one HTTP call per page or batch.
+
+    The Base reuses a single HTTPS connection, which is not thread-safe, so calls
+    from the sessions and job threads sharing the store are serialized with a lock.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        with timed('db.put'), self._lock:
+            return self.base.put(record)
+
+    def put_many(self, records):
+        stored = []
+        for start in range(0, len(records), DETA_PUT_MANY_LIMIT):
+            with timed('db.put'), self._lock:
+                response = self.base.put_many(records[start:start + DETA_PUT_MANY_LIMIT])
+            # Writing the same records again is safe, so the caller fails and can retry the whole call
+            failed = response.get('failed', {}).get('items', [])
+            if failed:
+                raise RuntimeError(f"Deta did not write {len(failed)} of {len(records)} records, "
+                                   f"e.g. {failed[0].get('key')}")
+            stored.extend(response['processed']['items'])
+        return stored
+
+    def fetch_all(self):
+        return self._fetch(None)
+
+    def fetch_since(self, date):
+        return self._fetch({'date?gte': date})
+
+    def query(self, date=None, prompt=None):
+        query = {}
+        if date is not None:
+            query['date'] = date
+        if prompt is not None:
+            query['prompt'] = prompt
+        return self._fetch(query or None)
+
+    def _fetch(self, query):
+        # Follow the `last` cursor, a single fetch only returns the first page
+        with timed('db.fetch'), self._lock:
+            response = self.base.fetch(query)
+        items = list(response.items)
+        while response.last:
+            with timed('db.fetch'), self._lock:
+                response = self.base.fetch(query, last=response.last)
+            items.extend(response.items)
+        return items
+
+
+class SQLiteStore(MetadataStore):
+    """
+    Records stored in a local SQLite file, with indexes on date and prompt.
+
+    The full record is kept as JSON so fields added later round-trip unchanged.
+    One connection is shared by all threads and serialized with a lock.
+    """
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS images ("
+                               "key TEXT PRIMARY KEY, date TEXT, prompt TEXT, image TEXT, data TEXT NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS images_date ON images (date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS images_prompt ON images (prompt)")
+
+    def put_many(self, records):
+        stored = []
+        for record in records:
+            record = dict(record)
+            record.setdefault('key', secrets.token_hex(6))
+            stored.append(record)
+        rows = [(r['key'], r.get('date'), r.get('prompt'), r.get('image'), json.dumps(r)) for r in stored]
+        with timed('db.put'), self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO images (key, date, prompt, image, data) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+        return stored
+
+    def fetch_all(self):
+        return self._select("SELECT data FROM images ORDER BY rowid")
+
+    def fetch_since(self, date):
+        return self._select("SELECT data FROM images WHERE date >= ? ORDER BY rowid", (date,))
+
+    def query(self, date=None, prompt=None):
+        conditions, params = [], []
+        if date is not None:
+            conditions.append("date = ?")
+            params.append(date)
+        if prompt is not None:
+            conditions.append("prompt = ?")
+            params.append(prompt)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._select(f"SELECT data FROM images{where} ORDER BY rowid", params)
+
+    def _select(self, sql, params=()):
+        with timed('db.fetch'), self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+def create_store(backend, deta_key=None, sqlite_path=DEFAULT_SQLITE_PATH):
+    """
+    Create the metadata store selected in the configuration
+
+    Parameters
+    ----------
+    backend : str
+        'deta' or 'sqlite'
+    deta_key : str, optional
+        Project key, required for the Deta backend
+    sqlite_path : str, optional
+        Database file, used by the SQLite backend
+
+    Returns
+    -------
+    MetadataStore
+    """
+    if backend == 'deta':
+        from deta import Deta
+        return DetaStore(Deta(deta_key).Base("aws-app"))
+    if backend == 'sqlite':
+        return SQLiteStore(sqlite_path)
+    raise ValueError(f"Invalid metadata backend: {backend}")
+
+
+def migrate(source, target):
+    """
+    Copy every record from one store into another, keeping their keys
+
+    Returns
+    -------
+    int
+        Number of records copied
+    """
+    records = source.fetch_all()
+    target.put_many(records)
+    return len(records)
+
+
+if __name__ == '__main__':
+    # One-shot copy of the Deta records into SQLite:
+    #   DETA_KEY=... python metadata_store.py --sqlite gallery.db
+    parser = argparse.ArgumentParser(description='Copy the gallery records from Deta into a SQLite database')
+    parser.add_argument('--sqlite', default=DEFAULT_SQLITE_PATH, help='SQLite database file to write to')
+    args = parser.parse_args()
+    copied = migrate(create_store('deta', deta_key=os.environ['DETA_KEY']),
+                     create_store('sqlite', sqlite_path=args.sqlite))
+    print(f"Copied {copied} records to {args.sqlite}")
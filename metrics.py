@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# Latency samples kept per stage for the percentiles, older ones are dropped
+MAX_SAMPLES = 2048
+# Prefix of the Prometheus metric names
+PROMETHEUS_PREFIX = 'aws_app'
+
+
+class _Span:
+    """
+    Handle yielded by `Metrics.timer`, set `nbytes` once the size of the transfer is known,
+    or `stage` to record the call under another stage, e.g. a lookup that found nothing
+    """
+    __slots__ = ('stage', 'nbytes')
+
+    def __init__(self, stage, nbytes):
+        self.stage = stage
+        self.nbytes = nbytes
+
+
+class _Stage:
+    __slots__ = ('samples', 'count', 'errors', 'seconds', 'nbytes')
+
+    def __init__(self, max_samples):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.nbytes = 0
+
+
+class Metrics:
+    """
+    Thread-safe, in-process timings and byte counts per stage of the app (an S3 download, a database fetch...).
+
+    Totals cover the life of the process. Percentiles are computed from the most recent
+    `max_samples` calls of each stage, so they follow the current behaviour.
+    """
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage, nbytes=0):
+        """
+        Time the block as one call of `stage`, counting it as an error if it raises
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 's3.download'
+        nbytes : int, optional
+            Bytes transferred, can also be set on the yielded span inside the block
+        """
+        span = _Span(stage, nbytes)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            self.record(span.stage, time.perf_counter() - start, span.nbytes, error=True)
+            raise
+        self.record(span.stage, time.perf_counter() - start, span.nbytes)
+
+    def record(self, stage, seconds, nbytes=0, error=False):
+        """
+        Add one call of `stage` that took `seconds`
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = _Stage(self.max_samples)
+            entry.samples.append(seconds)
+            entry.count += 1
+            entry.errors += int(error)
+            entry.seconds += seconds
+            entry.nbytes += nbytes or 0
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def summary(self):
+        """
+        Returns
+        -------
+        list of dict
+            Per stage, sorted by name: calls, errors, p50/p95/p99 latency in milliseconds,
+            total seconds, bytes, and throughput in MB/s while in the stage
+        """
+        with self._lock:
+            stages = [(name, list(entry.samples), entry.count, entry.errors, entry.seconds, entry.nbytes)
+                      for name, entry in sorted(self._stages.items())]
+        rows = []
+        for name, samples, count, errors, seconds, nbytes in stages:
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+            rows.append({'stage': name,
+                         'calls': count,
+                         'errors': errors,
+                         'p50_ms': round(float(p50), 1),
+                         'p95_ms': round(float(p95), 1),
+                         'p99_ms': round(float(p99), 1),
+                         'total_s': round(seconds, 3),
+                         'bytes': nbytes,
+                         'mb_per_s': round(nbytes / seconds / 1e6, 2) if seconds and nbytes else None})
+        return rows
+
+    def prometheus_text(self):
+        """
+        The metrics in the Prometheus text exposition format, as summaries with quantiles
+
+        Returns
+        -------
+        str
+        """
+        rows = self.summary()
+        name = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Time spent per call of each stage",
+                 f"# TYPE {name} summary"]
+        for row in rows:
+            label = f'stage="{row["stage"]}"'
+            for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+                lines.append(f'{name}{{{label},quantile="{quantile}"}} {row[key] / 1000}')
+            lines.append(f"{name}_sum{{{label}}} {row['total_s']}")
+            lines.append(f"{name}_count{{{label}}} {row['calls']}")
+        for metric, key, help_text in (('errors_total', 'errors', 'Calls of each stage that raised'),
+                                       ('bytes_total', 'bytes', 'Bytes transferred by each stage')):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_stage_{metric} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_{metric} counter")
+            for row in rows:
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_{metric}{{stage="{row["stage"]}"}} {row[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def json_lines(self):
+        """
+        One JSON object per stage, stamped with the current time, for appending to a log
+
+        Returns
+        -------
+        str
+        """
+        now = time.time()
+        return ''.join(json.dumps(dict(row, time=now)) + '\n' for row in self.summary())
+
+
+# Shared by every module and thread of the process
+REGISTRY = Metrics()
+
+
+def timed(stage, nbytes=0):
+    """
+    Time a block as one call of `stage` in the process-wide registry, see `Metrics.timer`
+    """
+    return REGISTRY.timer(stage, nbytes)
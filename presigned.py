@@ -0,0 +1,82 @@
+import html
+import threading
+import time
+
+# Lifetime of the presigned URLs, in seconds
+DEFAULT_EXPIRES_IN = 3600
+# URLs are regenerated once they are this close to expiring, so a page never shows one that dies while loading
+REFRESH_MARGIN = 300
+
+
+class PresignedUrlCache:
+    """
+    Presigned GET URLs for objects in one bucket, reused until shortly before they expire.
+
+    Signing happens locally, so a gallery view costs at most one signature per
+    image and usually none.
+    """
+
+    def __init__(self, s3_client, bucket, expires_in=DEFAULT_EXPIRES_IN, refresh_margin=REFRESH_MARGIN):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.expires_in = expires_in
+        self.refresh_margin = min(refresh_margin, expires_in // 2)
+        self._urls = {}  # key -> (url, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return a still valid cached URL for `key`, or None
+        """
+        with self._lock:
+            entry = self._urls.get(key)
+        if entry is not None and time.time() < entry[1] - self.refresh_margin:
+            return entry[0]
+        return None
+
+    def url(self, key):
+        """
+        Presigned GET URL for `key`, signed now if there is no fresh one cached
+        """
+        url = self.get(key)
+        if url is None:
+            expiry = time.time() + self.expires_in
+            url = self.s3_client.generate_presigned_url('get_object',
+                                                        Params={'Bucket': self.bucket, 'Key': key},
+                                                        ExpiresIn=self.expires_in)
+            with self._lock:
+                self._urls[key] = (url, expiry)
+        return url
+
+    def invalidate(self, key):
+        with self._lock:
+            self._urls.pop(key, None)
+
+
+def image_grid_html(urls, captions, columns=4):
+    """
+    HTML for a grid of <img> tags, the browser loads each image straight from its URL
+
+    Parameters
+    ----------
+    urls : list of str
+        Image URLs
+    captions : list of str
+        Caption under each image
+    columns : int, optional
+        Number of columns
+
+    Returns
+    -------
+    str
+        Markup for `st.markdown(..., unsafe_allow_html=True)`
+    """
+    cells = []
+    for url, caption in zip(urls, captions):
+        caption = html.escape(str(caption))
+        cells.append(f'<figure style="margin:0">'
+                     f'<img src="{html.escape(url)}" alt="{caption}" loading="lazy" style="width:100%">'
+                     f'<figcaption style="font-size:0.8em;color:gray">{caption}</figcaption>'
+                     f'</figure>')
+    return (f'<div style="display:grid;grid-template-columns:repeat({columns}, 1fr);gap:1rem">'
+            + ''.join(cells) + '</div>')
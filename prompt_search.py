@@ -0,0 +1,118 @@
+import bisect
+import math
+import re
+from collections import Counter
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Split a prompt into lowercase word tokens
+    """
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class PromptIndex:
+    """
+    In-process inverted index over the prompt of every gallery record.
+
+    Every query term is matched as a prefix of the indexed words, all terms must
+    match, and results are ranked with BM25. Records are added or replaced one at
+    a time, so the index is kept up to date as records are written.
+    """
+
+    def __init__(self):
+        self._postings = {}  # term -> {key: term frequency}
+        self._doc_terms = {}  # key -> Counter of terms
+        self._lengths = {}  # key -> number of words in the prompt
+        self._terms = []  # sorted vocabulary, for prefix lookups
+        self._total_length = 0
+
+    def add(self, key, prompt):
+        """
+        Index the prompt of a record, replacing whatever was indexed for `key`
+        """
+        self.remove(key)
+        terms = Counter(tokenize(prompt))
+        self._doc_terms[key] = terms
+        self._lengths[key] = sum(terms.values())
+        self._total_length += self._lengths[key]
+        for term, count in terms.items():
+            if term not in self._postings:
+                self._postings[term] = {}
+                bisect.insort(self._terms, term)
+            self._postings[term][key] = count
+
+    def remove(self, key):
+        """
+        Drop a record from the index, if present
+        """
+        terms = self._doc_terms.pop(key, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(key)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def search(self, query, limit=50, offset=0):
+        """
+        Find the records whose prompt matches every word of `query`
+
+        Parameters
+        ----------
+        query : str
+            Words to look for, each one matches as a prefix (e.g. 'sal dal' finds 'salvador dali')
+        limit : int, optional
+            Maximum number of keys returned
+        offset : int, optional
+            Number of ranked results to skip, for paging
+
+        Returns
+        -------
+        (list of str, int)
+            The keys on the requested page, best match first, and the total number of matches
+        """
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        if not query_terms or not self._doc_terms:
+            return [], 0
+
+        num_docs = len(self._doc_terms)
+        avg_length = self._total_length / num_docs or 1
+        scores = None
+        for query_term in query_terms:
+            term_scores = {}
+            for term in self._expand(query_term):
+                postings = self._postings[term]
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, count in postings.items():
+                    tf = count * (K1 + 1) / (count + K1 * (1 - B + B * self._lengths[key] / avg_length))
+                    term_scores[key] = term_scores.get(key, 0) + idf * tf
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {key: score + term_scores[key] for key, score in scores.items() if key in term_scores}
+            if not scores:
+                return [], 0
+
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return ranked[offset:offset + limit], len(ranked)
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def _expand(self, prefix):
+        # Every indexed term starting with `prefix`, found by binary search on the sorted vocabulary
+        start = bisect.bisect_left(self._terms, prefix)
+        end = start
+        while end < len(self._terms) and self._terms[end].startswith(prefix):
+            end += 1
+        return self._terms[start:end]
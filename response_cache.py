@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Default location of the cache database
+DEFAULT_CACHE_PATH = 'response_cache.db'
+# Cached responses older than this many seconds are ignored and dropped
+DEFAULT_TTL = 7 * 24 * 60 * 60
+# Least recently used entries are evicted beyond this many
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def hash_bytes(data):
+    """
+    Hex digest of input image or mask bytes, to use as part of a request key
+    """
+    return hashlib.sha256(data).hexdigest() if data is not None else None
+
+
+def request_key(**parts):
+    """
+    Normalized key for an API request
+
+    Strings have their whitespace collapsed, so prompts that only differ in spacing
+    share a key. Binary inputs should be passed through `hash_bytes` first.
+
+    Parameters
+    ----------
+    **parts
+        Everything that affects the response, e.g. model, prompt, size, n, image
+
+    Returns
+    -------
+    str
+        Hex digest identifying the request
+    """
+    normalized = {name: ' '.join(value.split()) if isinstance(value, str) else value
+                  for name, value in parts.items()}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of API results in a SQLite file, with a TTL and LRU eviction.
+
+    Values are small JSON documents: the text of a chat completion, or the S3 keys
+    where generated images were stored, never the image bytes themselves.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                               "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key):
+        """
+        Return the cached value for `key`, or None if it is missing or expired
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Store a JSON-serializable value, evicting expired and least recently used entries
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                               (key, json.dumps(value), now, now))
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._conn.execute("DELETE FROM responses WHERE key IN ("
+                               "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
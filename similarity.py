@@ -0,0 +1,202 @@
+import argparse
+import logging
+import os
+import numpy as np
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+# Side of the difference hash, 8 gives a 64-bit hash
+HASH_SIZE = 8
+# Hashes at most this many bits apart are treated as the same picture
+DEFAULT_MAX_DISTANCE = 10
+# Records hashed and written back per step of the backfill, only this many thumbnails are held at once
+BACKFILL_BATCH_SIZE = 25
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """
+    Difference hash of an image, robust to resizing, re-encoding and small edits
+
+    Parameters
+    ----------
+    image : PIL image
+        The image, a thumbnail gives the same hash as the original and is much cheaper
+    hash_size : int, optional
+        The hash has hash_size * hash_size bits
+
+    Returns
+    -------
+    str
+        The hash as hex, e.g. '3c3e1e0e0f070301'
+    """
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = np.asarray(small, dtype=np.int16)
+    # One bit per pixel, set when it is brighter than its right neighbour
+    bits = (pixels[:, :-1] > pixels[:, 1:]).ravel()
+    value = int(np.packbits(bits).tobytes().hex(), 16)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def hamming(a, b):
+    """
+    Number of bits that differ between two hashes, given as ints
+    """
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over hashes, for finding every hash within a Hamming distance.
+
+    Each node keeps its children by their distance to it, so a lookup only descends
+    into the children whose distance could hold a match (triangle inequality) and
+    visits a small part of the tree. Identical hashes share a node.
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, set of keys, {distance: child}]
+
+    def add(self, value, key):
+        """
+        Parameters
+        ----------
+        value : int
+            The hash
+        key : str
+            Record the hash belongs to
+        """
+        if self._root is None:
+            self._root = [value, {key}, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].add(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {key}, {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        Returns
+        -------
+        list of (int, str)
+            (distance, key) of every hash within `max_distance` of `value`, closest first
+        """
+        matches = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, key) for key in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches)
+
+
+def collapse(keys, hashes, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Keep one record of each group of near-duplicates
+
+    Parameters
+    ----------
+    keys : list of str
+        Record keys, in display order. The first record of a group is the one kept
+    hashes : dict
+        Hash (int) by record key, records without one are always kept
+    max_distance : int, optional
+        Records this close to a kept record are dropped
+
+    Returns
+    -------
+    list of str
+        The kept keys, in their original order
+    """
+    kept = []
+    tree = BKTree()
+    for key in keys:
+        value = hashes.get(key)
+        if value is not None:
+            if tree.search(value, max_distance):
+                continue
+            tree.add(value, key)
+        kept.append(key)
+    return kept
+
+
+def backfill(store, s3_client, bucket, width=256, batch_size=BACKFILL_BATCH_SIZE, max_workers=8):
+    """
+    Add a perceptual hash to every record that does not have one yet
+
+    Works through the records a batch at a time, downloading the thumbnails of one batch,
+    hashing them and writing the batch back, so memory use does not depend on the size of the gallery.
+
+    Parameters
+    ----------
+    store : MetadataStore
+        The records to update
+    s3_client : boto3 S3 client
+        Client used for the downloads
+    bucket : str
+        Bucket holding the images and their thumbnails
+    width : int, optional
+        Thumbnail width to hash, missing thumbnails are generated
+    batch_size : int, optional
+        Records per step
+    max_workers : int, optional
+        Thumbnail downloads in flight at once
+
+    Returns
+    -------
+    int
+        Number of records updated
+    """
+    from thumbnails import get_thumbnail
+
+    def hash_record(record):
+        # Return the exception instead of raising it, so one missing object does not stop the backfill
+        try:
+            data, _ = get_thumbnail(s3_client, bucket, record['image'], width)
+            return dict(record, phash=dhash(Image.open(BytesIO(data))))
+        except Exception as e:
+            return e
+
+    pending = [record for record in store.fetch_all() if not record.get('phash') and record.get('image')]
+    updated = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            records = []
+            for record, result in zip(batch, executor.map(hash_record, batch)):
+                if isinstance(result, Exception):
+                    logging.warning("Skipping %s: %s", record['image'], result)
+                    continue
+                records.append(result)
+            store.put_many(records)
+            updated += len(records)
+    return updated
+
+
+if __name__ == '__main__':
+    # Hash the images saved before perceptual hashes existed:
+    #   python similarity.py --backend sqlite --sqlite gallery.db
+    #   DETA_KEY=... python similarity.py --backend deta
+    from clients import create_s3_client
+    from metadata_store import create_store, DEFAULT_SQLITE_PATH
+    parser = argparse.ArgumentParser(description='Add perceptual hashes to the gallery records that have none')
+    parser.add_argument('--backend', default='deta', choices=('deta', 'sqlite'), help='Metadata store to update')
+    parser.add_argument('--sqlite', default=DEFAULT_SQLITE_PATH, help='SQLite database file, for the sqlite backend')
+    parser.add_argument('--bucket', default='luisappsbucket', help='Bucket holding the images')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help='Records per step')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    store = create_store(args.backend, deta_key=os.environ.get('DETA_KEY'), sqlite_path=args.sqlite)
+    updated = backfill(store, create_s3_client(), args.bucket, batch_size=args.batch_size)
+    print(f"Hashed {updated} records")
@@ -0,0 +1,71 @@
+import os
+import threading
+from io import BytesIO
+import pytest
+from PIL import Image
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from clients import create_s3_client
+from gallery import fetch_images
+import transfers
+
+BUCKET = 'test-bucket'
+SESSIONS = 2
+ROUNDS = 10
+
+
+def png_bytes():
+    """
+    A small PNG of random pixels, so every image has different bytes
+    """
+    image = Image.frombytes('RGB', (32, 32), os.urandom(32 * 32 * 3))
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def s3_client(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    # Anything written to the working directory would show up here
+    monkeypatch.chdir(tmp_path)
+    with moto.mock_aws():
+        client = create_s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_concurrent_sessions_only_see_their_own_bytes(s3_client, tmp_path):
+    barrier = threading.Barrier(SESSIONS)
+    errors = []
+
+    def session(number):
+        try:
+            for round_number in range(ROUNDS):
+                images = {f"session{number}/{round_number}-{i}.png": png_bytes() for i in range(4)}
+                # Start every round together, so uploads and downloads of both sessions overlap
+                barrier.wait()
+                for key, data in images.items():
+                    transfers.upload_bytes(s3_client, data, BUCKET, key)
+                fetched = dict(fetch_images(list(images), BUCKET, max_workers=4, s3_client=s3_client))
+                assert fetched == images
+                for key, data in fetched.items():
+                    Image.open(BytesIO(data)).load()
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=session, args=(number,)) for number in range(SESSIONS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors
+    # Nothing goes through the local disk, e.g. the old shared `temp` file
+    assert os.listdir(tmp_path) == []
+
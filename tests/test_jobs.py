@@ -0,0 +1,119 @@
+import sqlite3
+import time
+import pytest
+
+import jobs
+from response_cache import ResponseCache
+
+
+class StubWorker(jobs.JobWorker):
+    """
+    Generates numbered fake images and records them without S3 or a metadata store
+    """
+
+    def __init__(self):
+        super().__init__(None, None, 'test-bucket', None, ResponseCache(':memory:'))
+        self.generated = 0
+
+    def _call(self, job, fn, *args, **kwargs):
+        self.generated += 1
+        return f"image {self.generated}".encode(), 1
+
+    def _save(self, downloads, images, prompts, make_id):
+        return [{'image': f"{download.decode()}.png"} for download in downloads]
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    monkeypatch.setattr(jobs, 'open_image', lambda data: None)
+    return StubWorker()
+
+
+def test_batch_repeats_of_a_prompt_get_different_images(worker):
+    keys = [worker.generate({'id': str(index), 'params': {'prompt': 'a castle', 'save': True, 'index': index}})['keys']
+            for index in range(4)]
+    assert len({key for key, in keys}) == 4
+
+
+def test_repeated_single_prompt_is_served_from_the_cache(worker):
+    first = worker.generate({'id': '1', 'params': {'prompt': 'a castle', 'save': True}})
+    second = worker.generate({'id': '2', 'params': {'prompt': 'a castle', 'save': True}})
+    assert second['keys'] == first['keys']
+    assert worker.generated == 1
+
+
+def test_worker_survives_queue_errors(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.db'))
+    claim = queue.claim
+    failures = [sqlite3.OperationalError('database is locked')]
+
+    def flaky_claim():
+        if failures:
+            raise failures.pop()
+        return claim()
+
+    queue.claim = flaky_claim
+    worker = jobs.JobWorker(queue, None, 'test-bucket', None, None, poll_interval=0.01)
+    worker._handlers['save'] = lambda job: {'keys': []}
+    job_id = queue.enqueue('owner', 'save', {'prompts': []})
+    stop = worker.start()
+    try:
+        deadline = time.monotonic() + 5
+        while queue.get([job_id])[0]['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+    assert queue.get([job_id])[0]['status'] == 'done'
+
+
+def test_result_that_cannot_be_stored_fails_the_job(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.db'))
+    worker = jobs.JobWorker(queue, None, 'test-bucket', None, None)
+    worker._handlers['save'] = lambda job: {'keys': [object()]}
+    queue.enqueue('owner', 'save', {'prompts': []})
+    job = queue.claim()
+    worker.run_job(job)
+    assert queue.get([job['id']])[0]['status'] == 'failed'
+
+
+def test_unsaved_image_is_stored_under_the_results_prefix(worker, monkeypatch):
+    monkeypatch.setattr(jobs, 'put_content', lambda s3_client, data, bucket, config=None, prefix='':
+                        (f"{prefix}{data.decode()}.png", True))
+    result = worker.generate({'id': '1', 'params': {'prompt': 'a castle'}})
+    assert result['keys'] == [f"{jobs.RESULTS_PREFIX}image 1.png"]
+
+
+def test_repeated_unsaved_prompt_is_served_from_the_cache(worker, monkeypatch):
+    monkeypatch.setattr(jobs, 'put_content', lambda s3_client, data, bucket, config=None, prefix='':
+                        (f"{prefix}{data.decode()}.png", True))
+    first = worker.generate({'id': '1', 'params': {'prompt': 'a castle'}})
+    second = worker.generate({'id': '2', 'params': {'prompt': 'a castle'}})
+    assert second['keys'] == first['keys']
+    assert worker.generated == 1
+
+
+def test_saving_a_displayed_result_reuses_its_image(worker, monkeypatch):
+    monkeypatch.setattr(jobs, 'put_content', lambda s3_client, data, bucket, config=None, prefix='':
+                        (f"{prefix}{data.decode()}.png", True))
+    monkeypatch.setattr(jobs, 'download_bytes', lambda s3_client, bucket, key, config=None:
+                        key[len(jobs.RESULTS_PREFIX):-len('.png')].encode())
+    worker.generate({'id': '1', 'params': {'prompt': 'a castle'}})
+    saved = worker.generate({'id': '2', 'params': {'prompt': 'a castle', 'save': True}})
+    assert saved['keys'] == ['image 1.png']
+    assert worker.generated == 1
+
+
+def test_save_reads_results_from_the_bucket(worker, monkeypatch):
+    monkeypatch.setattr(jobs, 'download_bytes', lambda s3_client, bucket, key, config=None:
+                        key[len(jobs.RESULTS_PREFIX):-len('.png')].encode())
+    saved = worker.save({'id': '1', 'inputs': [b'upload'],
+                         'params': {'prompts': ['uploaded', 'generated'], 'keys': [f"{jobs.RESULTS_PREFIX}result.png"]}})
+    assert saved['keys'] == ['upload.png', 'result.png']
+
+
+def test_unfinished_jobs_are_not_limited(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.db'))
+    job_ids = [queue.enqueue('owner', 'generate', {'prompt': 'a castle', 'index': index}) for index in range(30)]
+    queue.enqueue('other', 'generate', {'prompt': 'a castle'})
+    queue.complete(queue.claim()['id'], {'keys': []})
+    assert queue.unfinished('owner') == job_ids[1:]
@@ -0,0 +1,23 @@
+import pytest
+
+from metadata_store import DetaStore
+
+
+class FakeBase:
+    """
+    Deta Base that rejects the records whose prompt is empty
+    """
+
+    def put_many(self, items):
+        return {'processed': {'items': [item for item in items if item['prompt']]},
+                'failed': {'items': [item for item in items if not item['prompt']]}}
+
+
+def test_deta_put_many_returns_the_written_records():
+    records = [{'key': 'a', 'prompt': 'a castle'}, {'key': 'b', 'prompt': 'a tower'}]
+    assert DetaStore(FakeBase()).put_many(records) == records
+
+
+def test_deta_put_many_raises_when_a_record_is_not_written():
+    with pytest.raises(RuntimeError, match='1 of 2'):
+        DetaStore(FakeBase()).put_many([{'key': 'a', 'prompt': 'a castle'}, {'key': 'b', 'prompt': ''}])
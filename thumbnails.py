@@ -0,0 +1,172 @@
+from clients import create_s3_client
+from io import BytesIO
+from botocore.exceptions import ClientError
+from PIL import Image, features
+from transfers import CACHE_CONTROL
+from metrics import timed
+
+# Thumbnails are stored in the same bucket as the originals, under this prefix
+THUMBNAIL_PREFIX = 'thumbs/'
+# Fixed thumbnail widths generated for every image, smallest first
+THUMBNAIL_WIDTHS = (256, 512)
+# WebP is much smaller than JPEG at the same quality, fall back when Pillow was built without it
+THUMBNAIL_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+THUMBNAIL_QUALITY = 80
+
+
+def thumbnail_key(key, width):
+    """
+    Name of the S3 object holding the thumbnail of `key` at `width`
+
+    Parameters
+    ----------
+    key : str
+        S3 object name of the original image
+    width : int
+        Thumbnail width, one of THUMBNAIL_WIDTHS
+
+    Returns
+    -------
+    str
+        e.g. 'thumbs/512/1675036590_2023-01-29.jpg.webp'
+    """
+    return f"{THUMBNAIL_PREFIX}{width}/{key}.{THUMBNAIL_FORMAT.lower()}"
+
+
+def pick_thumbnail_width(display_width):
+    """
+    Smallest thumbnail width that fills `display_width` pixels, or the largest one available
+    """
+    for width in THUMBNAIL_WIDTHS:
+        if width >= display_width:
+            return width
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def encode_thumbnail(image, width):
+    """
+    Downscale an image to `width`, keeping the aspect ratio, and encode it
+
+    Parameters
+    ----------
+    image : PIL image
+        The original image, it is not modified
+    width : int
+        Target width, images already narrower are not enlarged
+
+    Returns
+    -------
+    bytes
+        The encoded thumbnail
+    """
+    with timed('pil.encode') as span:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((width, image.height))
+        if THUMBNAIL_FORMAT == 'JPEG' and thumbnail.mode != 'RGB':
+            thumbnail = thumbnail.convert('RGB')
+        byte_stream = BytesIO()
+        thumbnail.save(byte_stream, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+        span.nbytes = byte_stream.tell()
+    return byte_stream.getvalue()
+
+
+def upload_thumbnails(image, bucket, key, s3_client=None):
+    """
+    Generate every thumbnail width for an image and upload them to S3
+
+    Parameters
+    ----------
+    image : PIL image
+        The original image
+    bucket : str
+        Bucket to upload to
+    key : str
+        S3 object name of the original image
+    s3_client : boto3 S3 client, optional
+        Client to use. If not specified a new one is created
+
+    Returns
+    -------
+    dict
+        Encoded thumbnail bytes by width
+    """
+    if s3_client is None:
+        s3_client = create_s3_client()
+    thumbnails = {}
+    for width in THUMBNAIL_WIDTHS:
+        thumbnails[width] = encode_thumbnail(image, width)
+        with timed('s3.upload', len(thumbnails[width])):
+            s3_client.put_object(Bucket=bucket,
+                                 Key=thumbnail_key(key, width),
+                                 Body=thumbnails[width],
+                                 ContentType=f"image/{THUMBNAIL_FORMAT.lower()}",
+                                 CacheControl=CACHE_CONTROL)
+    return thumbnails
+
+
+def get_thumbnail(s3_client, bucket, key, width):
+    """
+    Download the thumbnail of `key`, generating the thumbnails first if they do not exist yet
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the download, safe to share across threads
+    bucket : str
+        Bucket holding the original and its thumbnails
+    key : str
+        S3 object name of the original image
+    width : int
+        Thumbnail width, one of THUMBNAIL_WIDTHS
+
+    Returns
+    -------
+    (bytes, str)
+        Encoded thumbnail and the ETag of the thumbnail object, None for a freshly generated one
+    """
+    with timed('s3.download') as span:
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=thumbnail_key(key, width))
+            data = response['Body'].read()
+            span.nbytes = len(data)
+            return data, response.get('ETag')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            # Not a download of 0 bytes, misses are counted apart so they don't skew the download percentiles
+            span.stage = 's3.thumbnail_miss'
+
+    # Images saved before thumbnails existed are converted on first view
+    with timed('s3.download') as span:
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        span.nbytes = len(data)
+    with timed('pil.decode', len(data)):
+        image = Image.open(BytesIO(data))
+        image.load()
+    thumbnails = upload_thumbnails(image, bucket, key, s3_client=s3_client)
+    return thumbnails[width], None
+
+
+def ensure_thumbnail(s3_client, bucket, key, width):
+    """
+    Make sure the thumbnail of `key` at `width` exists in S3, generating the thumbnails if it does not
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the check, safe to share across threads
+    bucket : str
+        Bucket holding the original and its thumbnails
+    key : str
+        S3 object name of the original image
+    width : int
+        Thumbnail width, one of THUMBNAIL_WIDTHS
+    """
+    with timed('s3.head'):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=thumbnail_key(key, width))
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+    get_thumbnail(s3_client, bucket, key, width)
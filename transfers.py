@@ -0,0 +1,94 @@
+import mimetypes
+from io import BytesIO
+from boto3.s3.transfer import TransferConfig
+from metrics import timed
+
+MB = 1024 * 1024
+# Objects above this size are uploaded in parts and downloaded with parallel byte-range GETs
+MULTIPART_THRESHOLD = 8 * MB
+# Size of each part or range
+MULTIPART_CHUNKSIZE = 4 * MB
+# Parts in flight at once for a single object
+MAX_CONCURRENCY = 8
+# Objects in flight at once for a batch upload, see content_store.put_many_content
+BATCH_UPLOAD_WORKERS = 8
+# Browsers and CDNs may keep images for a day
+CACHE_CONTROL = 'public, max-age=86400'
+
+# Leading bytes of the image formats the app stores
+_SIGNATURES = ((b'\x89PNG\r\n\x1a\n', 'image/png'),
+               (b'\xff\xd8\xff', 'image/jpeg'),
+               (b'GIF8', 'image/gif'))
+
+
+def create_transfer_config(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                           max_concurrency=MAX_CONCURRENCY):
+    """
+    Transfer settings for uploads and downloads of single objects
+
+    Returns
+    -------
+    boto3.s3.transfer.TransferConfig
+    """
+    return TransferConfig(multipart_threshold=multipart_threshold,
+                          multipart_chunksize=multipart_chunksize,
+                          max_concurrency=max_concurrency,
+                          use_threads=True)
+
+
+def content_type_for(data, key):
+    """
+    MIME type of an object, taken from its bytes when possible
+
+    The bytes win over the extension, some objects are PNGs stored under a .jpg name.
+    """
+    for signature, content_type in _SIGNATURES:
+        if data[:len(signature)] == signature:
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+def upload_bytes(s3_client, data, bucket, key, config=None, content_type=None, cache_control=CACHE_CONTROL):
+    """
+    Upload in-memory data, in parallel parts when it is above the multipart threshold
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client
+        Client used for the upload
+    data : bytes
+        Contents of the object
+    bucket : str
+        Bucket to upload to
+    key : str
+        S3 object name
+    config : TransferConfig, optional
+        Multipart settings, boto3's defaults if not specified
+    content_type : str, optional
+        Detected from the bytes if not specified
+    cache_control : str, optional
+        Cache-Control header served with the object
+    """
+    extra_args = {'ContentType': content_type or content_type_for(data, key)}
+    if cache_control:
+        extra_args['CacheControl'] = cache_control
+    with timed('s3.upload', len(data)):
+        s3_client.upload_fileobj(BytesIO(data), bucket, key, ExtraArgs=extra_args, Config=config)
+
+
+def download_bytes(s3_client, bucket, key, config=None):
+    """
+    Download an object into memory, with parallel byte-range GETs when it is above the multipart threshold
+
+    Returns
+    -------
+    bytes
+        Contents of the object
+    """
+    buffer = BytesIO()
+    with timed('s3.download') as span:
+        s3_client.download_fileobj(bucket, key, buffer, Config=config)
+        span.nbytes = buffer.tell()
+    return buffer.getvalue()